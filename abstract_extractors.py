@@ -0,0 +1,192 @@
+import json
+import re
+import requests
+import bibtexparser
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.element import NavigableString
+import http_client
+
+# lxml is optional, it parses pages several times faster than html.parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# venue name (as passed to dblp_fetcher.py --name) -> extractor
+EXTRACTORS = {}
+
+
+def register(extractor_class):
+    """ Class decorator adding an extractor to the registry under its `venues`. """
+    for venue in extractor_class.venues:
+        EXTRACTORS[venue] = extractor_class()
+    return extractor_class
+
+
+def make_soup(html, parse_only=None, features=HTML_PARSER):
+    return BeautifulSoup(html, features, parse_only=parse_only)
+
+
+def has_class(*names):
+    """ Strainer attribute filter, the class attribute is not split into names yet while straining. """
+    return re.compile(r"(^|\s)(" + "|".join(re.escape(name) for name in names) + r")(\s|$)")
+
+
+def paragraphs_text(paragraphs):
+    """ Text of <p> elements, line breaks become spaces. """
+    abstract_text = []
+    for paragraph in paragraphs:
+        for content in paragraph.contents:
+            if isinstance(content, NavigableString):
+                abstract_text.append(content.strip())
+            elif content.name == "br":
+                abstract_text.append(" ")  # Replace <br> with space
+    return " ".join(abstract_text).strip()
+
+
+class AbstractExtractor:
+    """ Fetches the page of a paper and extracts its abstract.
+
+    A venue only defines `venues`, the `parse_only` strainer selecting the part
+    of the page that holds the abstract, and `extract`, which reads the abstract
+    from the (strained) soup. Only the strained elements are built, the rest
+    of the page is skipped by the parser.
+    """
+
+    venues = []
+    parse_only = None
+
+    def extract(self, soup):
+        """ Return the abstract found in `soup`, or None. """
+        raise NotImplementedError
+
+    def parse(self, html):
+        return self.extract(make_soup(html, self.parse_only))
+
+    def get_abstract(self, publication_url):
+        """ The abstract, "Abstract not found" if the page has none, None if fetching or parsing failed. """
+        try:
+            response = http_client.get(publication_url)
+            response.raise_for_status()  # Check that the request was successful
+            abstract = self.parse(response.text)
+            if not abstract:
+                print(f"Page parsed and abstract is not found for {publication_url}")
+                return "Abstract not found"
+            return abstract
+        except requests.RequestException as e:
+            print(f"Error fetching the page: {e}")
+            return None
+        except Exception as e:
+            print(f"Error parsing the page: {e}")
+            return None
+
+
+class MetaAbstractExtractor(AbstractExtractor):
+    """ Pages with a Google Scholar <meta name="citation_abstract"> tag. """
+
+    parse_only = SoupStrainer("meta", attrs={"name": "citation_abstract"})
+
+    def extract(self, soup):
+        meta = soup.find("meta", attrs={"name": "citation_abstract"})
+        return ' '.join(meta["content"].split()) if meta and meta.get("content") else None
+
+
+@register
+class NDSSExtractor(AbstractExtractor):
+    venues = ["NDSS"]
+    parse_only = SoupStrainer("div", class_=has_class("paper-data"))
+
+    def extract(self, soup):
+        main_content = soup.find("div", class_="paper-data")
+        if not main_content:
+            return None
+        # remove the paragraph that contains the title
+        return paragraphs_text(main_content.find_all("p")[2:])
+
+
+@register
+class USENIXSecurityExtractor(AbstractExtractor):
+    venues = ["USENIX Security"]
+    parse_only = SoupStrainer("div", class_=has_class("field-name-field-paper-description"))
+
+    def extract(self, soup):
+        main_content = soup.find("div", class_="field-name-field-paper-description")
+        if not main_content:
+            return None
+        return paragraphs_text(main_content.find_all("p"))
+
+
+@register
+class ICMLExtractor(AbstractExtractor):
+    # for ICML, the abstract can be found in the bibtex in the HTML, we parse the bibtex and get the abstract
+    venues = ["ICML"]
+    parse_only = SoupStrainer("code", id="bibtex")
+
+    def extract(self, soup):
+        bibtex_element = soup.find("code", id="bibtex")
+        if not bibtex_element:
+            return None
+        library = bibtexparser.parse_string(bibtex_element.text)
+        return library.entries[0]['abstract']
+
+
+@register
+class NeurIPSExtractor(AbstractExtractor):
+    # proceedings.neurips.cc, the abstract follows an <h4>Abstract</h4> heading
+    venues = ["NeurIPS"]
+    parse_only = SoupStrainer(["h4", "p"])
+
+    def extract(self, soup):
+        heading = soup.find("h4", string=re.compile(r"^\s*Abstract\s*$"))
+        if not heading:
+            return None
+        # the abstract is wrapped in nested <p> elements, the parser may split them
+        for paragraph in heading.find_all_next("p"):
+            abstract = ' '.join(paragraph.get_text().split())
+            if abstract:
+                return abstract
+        return None
+
+
+@register
+class ICLRExtractor(MetaAbstractExtractor):
+    # OpenReview forum pages
+    venues = ["ICLR"]
+
+
+@register
+class CCSExtractor(AbstractExtractor):
+    # ACM Digital Library, note that it often refuses automated requests
+    venues = ["CCS"]
+    parse_only = SoupStrainer(["div", "section"], class_=has_class("abstractSection", "abstractInFull", "abstract"))
+
+    def extract(self, soup):
+        section = soup.find(class_=["abstractSection", "abstractInFull", "abstract"])
+        if not section:
+            return None
+        return ' '.join(section.get_text(" ").split())
+
+
+@register
+class SPExtractor(AbstractExtractor):
+    # IEEE Xplore renders the page with JavaScript, the abstract is in the embedded document metadata
+    venues = ["S&P"]
+    parse_only = SoupStrainer("script")
+    METADATA = re.compile(r"xplGlobal\.document\.metadata\s*=\s*(\{.*?\});\s*$", re.DOTALL | re.MULTILINE)
+
+    def extract(self, soup):
+        for script in soup.find_all("script"):
+            match = self.METADATA.search(script.string or "")
+            if match:
+                abstract = json.loads(match.group(1)).get("abstract")
+                return ' '.join(abstract.split()) if abstract else None
+        return None
+
+
+def get_abstract(publication_name, publication_url):
+    extractor = EXTRACTORS.get(publication_name)
+    if extractor is None:
+        print("Publication not implemented yet!")
+        return ""  # Not implemented yet
+    return extractor.get_abstract(publication_url)
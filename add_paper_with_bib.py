@@ -1,9 +1,12 @@
 import argparse
-from datetime import datetime
+import json
+import os
 import time
-import bibtexparser
-from dblp_fetcher import update_existing_paper
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dblp_fetcher import update_existing_paper, find_existing_papers
 from serve import db, ResearchPaper # Assuming db is your database instance
+from bib_parsing import iter_bib_blocks, parse_bib_batch
 import tqdm
 from flask import Flask
 
@@ -12,106 +15,97 @@ app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///papers.db"
 db.init_app(app)
 
-def process_authors(authors):
-    # The input is the authors field from a BibTeX entry
-    # first in bib, the first name and the last name is separated by a comma
-    # we want to separate the first name and the last name with just a space
-    # and we want to separate the authors with a comma
-    # Besides, in bib, the family name is placed before the given name
-    # we want to reverse the order of the names
-    # first splice the authors with the "and" and the comma
-    authors_list = authors.split(' and ')
-    for i in range(len(authors_list)):
-        author = authors_list[i]
-        author_name_parts = author.split(', ')
-        if len(author_name_parts) == 1:  # name with {Firstname Lastname} like {Isaac Newton}
-            continue
-        elif len(author_name_parts) == 2:  # name with {Lastname, Firstname} like {Newton, Isaac}
-            author_name_parts.reverse()
-            authors_list[i] = ' '.join(author_name_parts)
-        elif len(author_name_parts) == 3:  # name with {Lastname, Suffix, Firstname} like {Newton, Jr., Isaac}
-            author_name_parts = [author_name_parts[2], author_name_parts[0], author_name_parts[1]]
-            authors_list[i] = ' '.join(author_name_parts)
-    authors = ', '.join(authors_list)
+# entries parsed per task of the process pool, and committed together
+BATCH_SIZE = 500
+DEFAULT_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
 
-    # sencond, in bib, there are some authors name with special characters
-    # we want to remove these special characters
-    authors = authors.replace('{', '')
-    authors = authors.replace('}', '')
-    # remove the "\" and the command after it
-    authors = authors.replace('\\', '')
-    authors = authors.replace("'", '')
-    authors = authors.replace('"', '')
-    authors = authors.replace('`', '')
-    authors = authors.replace('~', '')
-    authors = authors.replace('^', '')
-    return authors
 
-def get_publication_name_with_booktitle(booktitle):
-    # return the publication name from the booktitle
-    # example: 
-    # booktitle = "Proceedings of the 2023 ACM SIGSAC Conference on Computer and Communications Security"
-    # return "CCS"
-    if "SIGSAC Conference on Computer and Communications Security" in booktitle:
-        return "CCS"
-    else:
-        raise ValueError("The booktitle is not recognized")
+def iter_bib_batches(bib_file, batch_size=BATCH_SIZE):
+    """ Yield (string definitions, blocks) batches of the entries of an open .bib file. """
+    string_definitions, blocks = '', []
+    for line, text in iter_bib_blocks(bib_file):
+        block_type = text.lstrip()[1:].split('{', 1)[0].strip().lower()
+        if block_type == 'string':
+            # @string macros may be used by all later entries
+            string_definitions += text
+            continue
+        if block_type in ('comment', 'preamble'):
+            continue
+        blocks.append((line, text))
+        if len(blocks) >= batch_size:
+            yield string_definitions, blocks
+            blocks = []
+    if blocks:
+        yield string_definitions, blocks
 
-def add_paper_with_bib(bib_file_path):
-    with app.app_context():
-        bib_database = bibtexparser.parse_file(bib_file_path)
-        new_paper_count = 0
-        updated_paper_count = 0
-        for entry in tqdm.tqdm(bib_database.entries):
-            # Create a paper object from the entry
-            create_result = create_paper_from_entry(entry)
-            if create_result == 0:
-                new_paper_count += 1
-            else:
-                updated_paper_count += 1
-        db.session.commit()
-        print(f"New papers added: {new_paper_count}")
-        print(f"Papers updated: {updated_paper_count}")
-        print(f"Total papers: {new_paper_count + updated_paper_count}")
 
-def create_paper_from_entry(entry):
-    # Create a paper object from a BibTeX entry
-    # return 0 means the paper is new, return 1 means the paper is updated
+def parse_batches(batches, workers=DEFAULT_WORKERS):
+    """ Parse batches in a process pool, in order, with only a few batches in flight. """
+    if workers <= 1:
+        for batch in batches:
+            yield parse_bib_batch(batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(parse_bib_batch, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-    # print(entry)
-    title = entry['title']
-    authors = entry['author']
-    authors = process_authors(authors)
-    abstract = entry['abstract']
-    publication_year = entry['year']
-    publication_date = datetime.strptime(
-            publication_year, "%Y"
-        )  # Convert year to datetime
-    publication_name = get_publication_name_with_booktitle(entry['booktitle'])
-    publication_url = entry['url']
 
-    # check if the paper already exists
-    existing_paper = ResearchPaper.query.filter_by(
-        title=title, authors=authors
-    ).first()
+def add_papers(papers):
+    """ Add or update the papers of a batch, return the (new, updated) counts. """
+    new_paper_count, updated_paper_count = 0, 0
+    existing_papers = find_existing_papers({(paper['title'], paper['authors']) for paper in papers})
+    for paper in papers:
+        key = (paper['title'], paper['authors'])
+        if key in existing_papers:
+            update_existing_paper(
+                existing_papers[key], paper['publication_name'], paper['publication_date'],
+                paper['publication_url'], paper['abstract'], db=db
+            )
+            updated_paper_count += 1
+        else:
+            new_paper = ResearchPaper(**paper)
+            db.session.add(new_paper)
+            # the same paper may appear again later in the file
+            existing_papers[key] = new_paper
+            new_paper_count += 1
+    return new_paper_count, updated_paper_count
 
-    if existing_paper:
-        update_existing_paper(
-            existing_paper, publication_name, publication_date, publication_url, abstract,db=db
-        )
-        return 1
-    else:
-        new_paper = ResearchPaper(
-            title=title,
-            authors=authors,
-            abstract=abstract,  # DBLP has no abstract information
-            publication_name=publication_name,
-            publication_date=publication_date,
-            publication_url=publication_url,
-        )
-        db.session.add(new_paper)
-        return 0
 
+def add_paper_with_bib(bib_file_path, workers=DEFAULT_WORKERS, batch_size=BATCH_SIZE, rejects_path=None):
+    """ Stream the entries of a .bib file into the database.
+
+    Entries are parsed in a process pool and every batch is committed, so an
+    interrupted import keeps the batches it finished. Entries that can not be
+    parsed or whose venue is not recognized are written to the rejects report.
+    """
+    rejects_path = rejects_path or bib_file_path + '.rejects.jsonl'
+    with app.app_context():
+        new_paper_count, updated_paper_count, rejected_count = 0, 0, 0
+        with open(bib_file_path, 'r', encoding='utf-8') as bib_file, open(rejects_path, 'w') as rejects_file, \
+                tqdm.tqdm(unit=' entries') as progress:
+            for results in parse_batches(iter_bib_batches(bib_file, batch_size), workers):
+                papers = [result['paper'] for result in results if 'paper' in result]
+                for result in results:
+                    if 'paper' not in result:
+                        rejects_file.write(json.dumps(result) + '\n')
+                        rejected_count += 1
+                new_count, updated_count = add_papers(papers)
+                db.session.commit()
+                new_paper_count += new_count
+                updated_paper_count += updated_count
+                progress.update(len(results))
+        print(f"New papers added: {new_paper_count}")
+        print(f"Papers updated: {updated_paper_count}")
+        print(f"Total papers: {new_paper_count + updated_paper_count}")
+        if rejected_count:
+            print(f"Entries rejected: {rejected_count}, see {rejects_path}")
+        else:
+            os.remove(rejects_path)
 
 
 if __name__ == "__main__":
@@ -122,7 +116,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--bib_path", type=str, required=True, help="Path to the bib file."
     )
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Processes parsing entries")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE, help="Entries committed at a time")
+    parser.add_argument(
+        "--rejects", type=str, default=None, help="Report of rejected entries (default: <bib_path>.rejects.jsonl)"
+    )
     args = parser.parse_args()
-    add_paper_with_bib(args.bib_path)
+    add_paper_with_bib(args.bib_path, args.workers, args.batch_size, args.rejects)
     print(f"Execution time: {time.time() - start_time}")
 
@@ -0,0 +1,118 @@
+import os
+import time
+import numpy as np
+
+# hnswlib is optional, without it similar papers are found by exact search
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+ANN_INDEX_FILE = 'semantic_hnsw.bin'
+
+
+def ann_available():
+    return hnswlib is not None
+
+
+class SemanticANNIndex:
+    """ HNSW index over the normalised semantic vectors, labelled by paper id.
+
+    Inner product of normalised vectors is the cosine similarity, hnswlib
+    reports it as the distance 1 - similarity.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def create(cls, dim, max_elements, ef_construction=200, m=16):
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.init_index(max_elements=max(max_elements, 1), ef_construction=ef_construction, M=m)
+        return cls(index)
+
+    @classmethod
+    def load(cls, dim, filename=ANN_INDEX_FILE):
+        if not ann_available() or not os.path.exists(filename):
+            return None
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.load_index(filename)
+        return cls(index)
+
+    def save(self, filename=ANN_INDEX_FILE):
+        tmp_filename = filename + '.tmp'
+        self.index.save_index(tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def paper_ids(self):
+        return np.array(self.index.get_ids_list(), dtype=np.int64)
+
+    def add(self, paper_ids, vectors):
+        """ Insert new papers, papers already in the index get their vector replaced. """
+        if len(paper_ids) == 0:
+            return
+        needed = self.index.get_current_count() + len(paper_ids)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, int(self.index.get_max_elements() * 1.5)))
+        self.index.add_items(np.asarray(vectors, dtype=np.float32), np.asarray(paper_ids, dtype=np.int64))
+
+    def remove(self, paper_ids):
+        for paper_id in paper_ids:
+            try:
+                self.index.mark_deleted(int(paper_id))
+            except RuntimeError:
+                # already deleted by an earlier run
+                pass
+
+    def query(self, vector, k, ef=None):
+        """ Return (paper_ids, similarities) of the `k` approximate nearest papers. """
+        k = min(k, self.index.get_current_count())
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        self.index.set_ef(max(ef or 0, k * 2, 50))
+        labels, distances = self.index.knn_query(np.asarray(vector, dtype=np.float32), k=k)
+        return labels[0].astype(np.int64), 1 - distances[0]
+
+
+def update_ann_index(paper_ids, matrix, changed_ids=None, filename=ANN_INDEX_FILE):
+    """ Bring the HNSW index in line with the semantic store.
+
+    Only `changed_ids` and the papers missing from an existing index are
+    (re)inserted into it, papers that left the store are marked deleted.
+    Without an index file everything is inserted.
+    """
+    start_time = time.time()
+    ann = SemanticANNIndex.load(matrix.shape[1], filename)
+    if ann is None:
+        ann = SemanticANNIndex.create(matrix.shape[1], len(paper_ids))
+        changed_ids = paper_ids
+    else:
+        # papers that never made it into the index (e.g. added while it was not kept up to
+        # date) are inserted too, also when the caller only knows about its own changes
+        missing_ids = np.setdiff1d(paper_ids, ann.paper_ids())
+        changed_ids = missing_ids if changed_ids is None else np.union1d(np.asarray(changed_ids, dtype=np.int64), missing_ids)
+    removed_ids = np.setdiff1d(ann.paper_ids(), paper_ids)
+    ann.remove(removed_ids)
+    changed_rows = np.searchsorted(paper_ids, np.asarray(changed_ids, dtype=np.int64))
+    ann.add(paper_ids[changed_rows], matrix[changed_rows])
+    ann.save(filename)
+    print(f"ANN index updated with {len(changed_rows)} papers, {len(removed_ids)} removed, in {time.time() - start_time} seconds.")
+    return ann
+
+
+def measure_recall(ann, paper_ids, matrix, k=25, sample_size=200, seed=0):
+    """ Average share of the exact top `k` neighbours the ANN index returns. """
+    if len(paper_ids) <= 1:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    sample_rows = rng.choice(len(paper_ids), size=min(sample_size, len(paper_ids)), replace=False)
+    k = min(k, len(paper_ids) - 1)
+    recalls = []
+    for row in sample_rows:
+        similarities = matrix @ matrix[row]
+        similarities[row] = -np.inf
+        exact_ids = set(paper_ids[np.argpartition(-similarities, k - 1)[:k]].tolist())
+        ann_ids, _ = ann.query(matrix[row], k + 1)
+        ann_ids = [pid for pid in ann_ids.tolist() if pid != paper_ids[row]][:k]
+        recalls.append(len(exact_ids.intersection(ann_ids)) / k)
+    return float(np.mean(recalls))
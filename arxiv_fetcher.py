@@ -1,9 +1,14 @@
 import feedparser
 import argparse
-from datetime import datetime
+import json
+import os
+import time
+from datetime import datetime, timedelta
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from serve import ResearchPaper, db, read_settings  # Adjust the import as necessary
+from sqlalchemy import or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from serve import ResearchPaper, db, read_settings, link_papers  # Adjust the import as necessary
 from urllib.parse import quote  # Import for URL encoding
 import unicodedata
 import tqdm
@@ -18,85 +23,231 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///papers.db'  # Ensure this mat
 db.init_app(app)
 
 ARXIV_API_URL = "http://export.arxiv.org/api/query?search_query="
+# existing papers are looked up this many arxiv ids at a time
+LOOKUP_CHUNK_SIZE = 500
+# columns replaced when a newer version of a paper is fetched
+UPSERT_COLUMNS = ['title', 'authors', 'abstract', 'arxiv_upload_date', 'arxiv_category', 'arxiv_url']
+# progress and high-water mark of --harvest runs, per query
+HARVEST_STATE_FILE = 'arxiv_harvest_state.json'
+# the arXiv API returns at most 2000 results per request
+MAX_PAGE_SIZE = 2000
+# the first harvest of a query fetches the papers updated in the last days, not the whole history
+FIRST_HARVEST_DAYS = 7
 
-def fetch_arxiv_papers(query, max_results):
+def parse_entry(entry):
+    """ Column values of the paper of a feed entry. """
+    # title may contain unwanted spaces and line breaks, and abstract unwanted line breaks
+    cleaned_abstract = entry.summary.replace('\n', ' ').replace('\r', '')
+    return {
+        'arxiv_id': entry.id.split('/abs/')[-1].split('v')[0],  # entry.id is the URL, not the id
+        'title': ' '.join(entry.title.split()),
+        'authors': normalize_authors(', '.join(author.name for author in entry.authors)),
+        'abstract': ' '.join(cleaned_abstract.split()),
+        'arxiv_upload_date': datetime.strptime(entry.published, '%Y-%m-%dT%H:%M:%SZ'),
+        'arxiv_category': ', '.join(tag['term'] for tag in entry.tags) if entry.get('tags') else None,
+        'arxiv_url': entry.id,  # looks like "http://arxiv.org/abs/1711.11357v1"
+    }
+
+
+def existing_upload_dates(arxiv_ids):
+    """ {arxiv_id: upload date} of the papers already in the database, one IN query per chunk. """
+    upload_dates = {}
+    for start in range(0, len(arxiv_ids), LOOKUP_CHUNK_SIZE):
+        chunk = arxiv_ids[start:start + LOOKUP_CHUNK_SIZE]
+        upload_dates.update(db.session.query(ResearchPaper.arxiv_id, ResearchPaper.arxiv_upload_date).filter(
+            ResearchPaper.arxiv_id.in_(chunk)).all())
+    return upload_dates
+
+
+def upsert_papers(papers):
+    """ Insert new papers and update existing ones, only where the upload date is newer. """
+    if not papers:
+        return
+    statement = sqlite_insert(ResearchPaper.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ResearchPaper.arxiv_id],
+        set_={column: statement.excluded[column] for column in UPSERT_COLUMNS},
+        where=or_(ResearchPaper.arxiv_upload_date.is_(None),
+                  ResearchPaper.arxiv_upload_date < statement.excluded.arxiv_upload_date))
+    db.session.execute(statement, papers)
+    # the bulk statement bypasses the ORM, so refresh the author and category links here
+    arxiv_ids = [paper['arxiv_id'] for paper in papers]
+    linked = []
+    for start in range(0, len(arxiv_ids), LOOKUP_CHUNK_SIZE):
+        linked.extend(db.session.query(ResearchPaper.id, ResearchPaper.authors, ResearchPaper.arxiv_category).filter(
+            ResearchPaper.arxiv_id.in_(arxiv_ids[start:start + LOOKUP_CHUNK_SIZE])).all())
+    link_papers(db.session, linked)
+
+
+def ingest_papers(papers):
+    """ Write parsed papers, return the (new, updated, already existing) counts. """
+    new_papers, updated_papers, already_exists = 0, 0, 0
+    upload_dates = existing_upload_dates(list({paper['arxiv_id'] for paper in papers}))
+    # the newest version of every paper that has to be written
+    to_write = {}
+    for paper in papers:
+        arxiv_id = paper['arxiv_id']
+        if arxiv_id not in upload_dates:
+            new_papers += 1
+        elif upload_dates[arxiv_id] is None or upload_dates[arxiv_id] < paper['arxiv_upload_date']:
+            # Update all fields if the paper has a newer upload date
+            updated_papers += 1
+        else:
+            already_exists += 1
+            continue
+        upload_dates[arxiv_id] = paper['arxiv_upload_date']
+        to_write[arxiv_id] = paper
+    upsert_papers(list(to_write.values()))
+    return new_papers, updated_papers, already_exists
+
+
+def fetch_arxiv_papers(query, max_results, api_url=ARXIV_API_URL):
     with app.app_context():
         if " " in query:
             query = quote(query)
-        # print(f"Query before: {query}")
-        # print(f"encoded_query:{encoded_query}")
         print(f"Fetched papers for query: {query}")
-        url = f"{ARXIV_API_URL}{query}&max_results={max_results}"
+        url = f"{api_url}{query}&max_results={max_results}"
         feed = feedparser.parse(url)
-        # print(feed)
+        papers = [parse_entry(entry) for entry in tqdm.tqdm(feed.entries)]
+        stats = ingest_papers(papers)
+        db.session.commit()
+        return (len(papers),) + stats
+
+
+def load_harvest_state(state_file=HARVEST_STATE_FILE):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as file:
+        return json.load(file)
+
+
+def save_harvest_state(state, state_file=HARVEST_STATE_FILE):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(state, file, indent=4)
+    os.replace(tmp_file, state_file)
+
+
+def fetch_feed_page(url, start, delay, retries=3):
+    """ Parse one page of results, retrying failed requests and the empty pages the arXiv API
+    sometimes returns mid-listing.
+
+    feedparser does not raise on HTTP or connection errors, so they are detected
+    here. A page that still fails after `retries` retries raises ConnectionError,
+    the harvest state keeps the page so the next run retries it.
+    """
+    for attempt in range(retries + 1):
+        feed = feedparser.parse(url)
+        status = feed.get('status')
+        total_results = int(feed.feed.get('opensearch_totalresults', 0) or 0)
+        if status is not None and status != 200:
+            error = f"HTTP status {status}"
+        elif feed.get('bozo') and not feed.entries:
+            error = f"unreadable response: {feed.get('bozo_exception')}"
+        elif not feed.entries and total_results > start:
+            error = f"empty page of {total_results} results"
+        else:
+            return feed
+        if attempt == retries:
+            raise ConnectionError(f"Request for the results at start={start} failed: {error}")
+        print(f"Request for the results at start={start} failed ({error}), retrying.")
+        time.sleep(delay * 2 ** attempt)
+
+
+def harvest_arxiv_papers(query, max_results=None, page_size=100, delay=3.0, api_url=ARXIV_API_URL,
+                         state_file=HARVEST_STATE_FILE, since=None):
+    """ Page through the most recently updated papers of `query`, newest first.
+
+    Every page is written to the database as soon as it arrives. The harvest
+    stops at the first paper not updated since the last completed run (the
+    high-water mark in `state_file`), or at the end of the results. The first
+    harvest of a query stops at papers updated before `since` (a datetime,
+    FIRST_HARVEST_DAYS ago by default). A harvest that fails or is cut short by
+    `max_results` resumes after its last committed page, and the high-water
+    mark only moves once a harvest is complete.
+    """
+    with app.app_context():
+        if " " in query:
+            query = quote(query)
+        page_size = min(page_size, MAX_PAGE_SIZE)
+        state = load_harvest_state(state_file)
+        query_state = state.setdefault(query, {'high_water_mark': None})
+        if 'next_start' in query_state:
+            print(f"Resuming the harvest of {query} at result {query_state['next_start']}.")
+        else:
+            if since is None:
+                since = datetime.utcnow() - timedelta(days=FIRST_HARVEST_DAYS)
+            query_state.update(next_start=0, run_high_water_mark=query_state['high_water_mark'],
+                               run_stop_mark=query_state['high_water_mark'] or since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        # only papers updated after the last completed run are new
+        stop_mark = query_state.get('run_stop_mark', query_state['high_water_mark'])
+        print(f"Harvesting papers for query: {query}, updated after {stop_mark or 'the beginning'}")
+
         total_fetched, new_papers, updated_papers, already_exists = 0, 0, 0, 0
+        complete = False
+        while max_results is None or total_fetched < max_results:
+            start = query_state['next_start']
+            size = page_size if max_results is None else min(page_size, max_results - total_fetched)
+            url = f"{api_url}{query}&sortBy=lastUpdatedDate&sortOrder=descending&start={start}&max_results={size}"
+            feed = fetch_feed_page(url, start, delay)
+            entries = feed.entries
+            total_results = int(feed.feed.get('opensearch_totalresults', 0) or 0)
+            # ISO 8601 timestamps in UTC compare in time order. Papers updated in the same second as
+            # the mark are fetched again, in case the last run did not see all of them
+            fresh_entries = [entry for entry in entries if stop_mark is None or entry.updated >= stop_mark]
+            papers = [parse_entry(entry) for entry in fresh_entries]
+            page_stats = ingest_papers(papers)
+            db.session.commit()
 
-        for entry in tqdm.tqdm(feed.entries):
-            # print("-----------------------------------")
-            # print(f"Title: {entry.title}")
-            # print(f"Authors: {entry.authors}")
-            # print(f"Abstract: {entry.summary}")
-            # print("-----------------------------------")
-
-            total_fetched += 1
-            entry_id = entry.id.split('/abs/')[-1].split('v')[0]  # entry.id is the URL, not the id
-            existing_paper = ResearchPaper.query.filter_by(arxiv_id=entry_id).first()
-            upload_date = datetime.strptime(entry.published, '%Y-%m-%dT%H:%M:%SZ')
-
-            # Extract and concatenate categories
-            categories = ', '.join(tag['term'] for tag in entry.tags) if entry.tags else None
-            # normalize authors
-            authors = ', '.join(author.name for author in entry.authors)
-            authors = normalize_authors(authors)
-            # title may contain unwanted spaces and line breaks
-            entry.title = ' '.join(entry.title.split())
-            # And abstract may contain unwanted line breaks
-            cleaned_abstract = entry.summary.replace('\n', ' ').replace('\r', '')
-            cleaned_abstract = ' '.join(cleaned_abstract.split())
-            entry.summary = cleaned_abstract
-            if existing_paper:
-                if existing_paper.arxiv_upload_date < upload_date:
-                    # Update all fields if the paper has a newer upload date
-                    existing_paper.title = entry.title
-                    existing_paper.authors = authors
-                    existing_paper.abstract = entry.summary
-                    existing_paper.arxiv_upload_date = upload_date
-                    existing_paper.arxiv_category = categories  # Update categories
-                    existing_paper.arxiv_url = entry.id
-                    updated_papers += 1
-                else:
-                    already_exists += 1
-            else:
-                new_paper = ResearchPaper(
-                    title=entry.title,
-                    authors=authors,
-                    abstract=entry.summary,
-                    arxiv_upload_date=upload_date,
-                    arxiv_url=entry.id,
-                    arxiv_id=entry_id,
-                    arxiv_category=categories  # Add categories
-                )
-                db.session.add(new_paper)
-                new_papers += 1
-                # print(entry.id)  # the id looks like "http://arxiv.org/abs/1711.11357v1"
-        
-        db.session.commit()
-        return total_fetched, new_papers, updated_papers, already_exists
+            total_fetched += len(papers)
+            new_papers += page_stats[0]
+            updated_papers += page_stats[1]
+            already_exists += page_stats[2]
+            query_state['next_start'] = start + len(entries)
+            query_state['run_high_water_mark'] = max([entry.updated for entry in fresh_entries] +
+                                                     [query_state['run_high_water_mark'] or ''])
+            save_harvest_state(state, state_file)
+            print(f"Page at start={start}: {len(papers)} papers, {page_stats[0]} new, {page_stats[1]} updated.")
+            if len(fresh_entries) < len(entries) or query_state['next_start'] >= total_results:
+                # reached papers of the last run, or the end of the results
+                complete = True
+                break
+            time.sleep(delay)
 
+        if complete:
+            query_state['high_water_mark'] = query_state.pop('run_high_water_mark') or None
+            query_state.pop('run_stop_mark', None)
+            del query_state['next_start']
+            save_harvest_state(state, state_file)
+        else:
+            # the papers between here and the last run are still missing, keep the old mark
+            print(f"Stopped after {total_fetched} papers, the next harvest continues at result {query_state['next_start']}.")
+        return total_fetched, new_papers, updated_papers, already_exists
 
 
 if __name__ == "__main__":
     settings = read_settings()
     default_query = settings['default_arxiv_query']
     parser = argparse.ArgumentParser(description='Fetch papers from arXiv and store them in the database.')
-    parser.add_argument('--num', type=int, default=10, help='Number of papers to fetch', metavar='max_results')
+    parser.add_argument('--num', type=int, default=None, help='Number of papers to fetch (default 10, no limit with --harvest)', metavar='max_results')
     parser.add_argument('-q', '--query', type=str, default=default_query, help='Query to search for papers')
+    parser.add_argument('--harvest', action='store_true', help='Page through the papers updated since the last harvest')
+    parser.add_argument('--page_size', type=int, default=100, help='Papers per request in harvest mode')
+    parser.add_argument('--delay', type=float, default=3.0, help='Seconds to wait between requests in harvest mode')
+    parser.add_argument('--api_url', type=str, default=ARXIV_API_URL, help='arXiv API query URL, e.g. of a local test server')
+    parser.add_argument('--state_file', type=str, default=HARVEST_STATE_FILE, help='Harvest progress file')
+    parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m-%d'), default=None,
+                        help=f'First harvest of a query only: fetch papers updated since YYYY-MM-DD (default {FIRST_HARVEST_DAYS} days ago)')
 
     args = parser.parse_args()
 
-    stats = fetch_arxiv_papers(query=args.query, max_results=args.num)
+    if args.harvest:
+        stats = harvest_arxiv_papers(query=args.query, max_results=args.num, page_size=args.page_size, delay=args.delay,
+                                     api_url=args.api_url, state_file=args.state_file, since=args.since)
+    else:
+        stats = fetch_arxiv_papers(query=args.query, max_results=args.num or 10, api_url=args.api_url)
     
     print(f"Total papers fetched: {stats[0]}")
     print(f"New papers added: {stats[1]}")
     print(f"Papers updated: {stats[2]}")
-    print(f"Papers already existing in the database: {stats[3]}")
+    print(f"Papers already existing in the database: {stats[3]}")
\ No newline at end of file
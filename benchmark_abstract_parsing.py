@@ -0,0 +1,45 @@
+""" Compare the parse time of abstract pages: whole page with html.parser (the
+previous implementation) against the strained parse of abstract_extractors.
+
+Pages are fetched through http_client, so pages in http_cache/ are reused and
+--offline runs without the network.
+"""
+import argparse
+import time
+from bs4 import BeautifulSoup
+import http_client
+from abstract_extractors import EXTRACTORS, HTML_PARSER
+
+
+def time_parse(parse, html, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        result = parse(html)
+    return (time.perf_counter() - start_time) / repeat, result
+
+
+def benchmark(venue, urls, repeat=5):
+    extractor = EXTRACTORS[venue]
+    total_old, total_new = 0.0, 0.0
+    for url in urls:
+        html = http_client.get(url).text
+        old_time, old_abstract = time_parse(lambda page: extractor.extract(BeautifulSoup(page, "html.parser")), html, repeat)
+        new_time, new_abstract = time_parse(extractor.parse, html, repeat)
+        total_old += old_time
+        total_new += new_time
+        same = "same abstract" if old_abstract == new_abstract else "DIFFERENT abstract"
+        print(f"{url}: {old_time * 1000:.1f} ms -> {new_time * 1000:.1f} ms ({len(html) / 1024:.0f} KB, {same})")
+    print(f"{venue}, {len(urls)} pages, {HTML_PARSER} with strainer: {total_old * 1000 / len(urls):.1f} ms -> "
+          f"{total_new * 1000 / len(urls):.1f} ms per page, {total_old / max(total_new, 1e-9):.1f}x faster")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the abstract parsers.")
+    parser.add_argument("--venue", type=str, required=True, choices=sorted(EXTRACTORS), help="Publication name")
+    parser.add_argument("--urls", type=str, nargs="+", required=True, help="Pages of papers of the venue")
+    parser.add_argument("--repeat", type=int, default=5, help="Parses of every page")
+    parser.add_argument("--offline", action="store_true", help="Only use pages from the cache")
+    args = parser.parse_args()
+
+    http_client.configure(offline=args.offline)
+    benchmark(args.venue, args.urls, args.repeat)
@@ -0,0 +1,58 @@
+""" Compare the query embedding latency of the encoder backends of query_encoder.py.
+
+Every backend encodes the same queries one at a time, like the server does,
+and its vectors are compared with the ones of the first backend. Backends that
+can not be loaded are skipped.
+"""
+import argparse
+import time
+import numpy as np
+from query_encoder import ENCODER_BACKENDS, load_model
+from semantic_store import normalize_rows
+
+SAMPLE_QUERIES = [
+    "adversarial examples",
+    "membership inference attacks against machine learning models",
+    "federated learning privacy",
+    "fuzzing network protocols with large language models",
+    "side channel attacks on cryptographic implementations",
+    "graph neural network robustness certification",
+    "malware detection",
+    "differential privacy for deep learning with formal guarantees",
+]
+
+
+def benchmark(backends, queries, repeat=5):
+    reference = None
+    for backend in backends:
+        start_time = time.time()
+        try:
+            model = load_model(backend)
+        except Exception as e:
+            # no fallback here, the row would show the torch numbers under another name
+            print(f"{backend}: not available, skipped: {e}")
+            continue
+        load_time = time.time() - start_time
+        model.encode(queries[:1])  # warm up
+        latencies = []
+        for _ in range(repeat):
+            for query in queries:
+                start_time = time.perf_counter()
+                model.encode([query])
+                latencies.append(time.perf_counter() - start_time)
+        vectors = normalize_rows(model.encode(queries))
+        if reference is None:
+            reference_backend, reference = backend, vectors
+        agreement = float(np.min(np.sum(vectors * reference, axis=1)))
+        latencies = np.array(latencies) * 1000
+        print(f"{backend}: loaded in {load_time:.1f} s, {np.mean(latencies):.1f} ms mean, "
+              f"{np.percentile(latencies, 95):.1f} ms p95 per query, min cosine to {reference_backend} {agreement:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the query encoder backends.")
+    parser.add_argument("--backends", type=str, nargs="+", default=ENCODER_BACKENDS, choices=ENCODER_BACKENDS,
+                        help="Backends to compare, the first one that loads is the reference")
+    parser.add_argument("--repeat", type=int, default=5, help="Times every query is encoded")
+    args = parser.parse_args()
+    benchmark(args.backends, SAMPLE_QUERIES, args.repeat)
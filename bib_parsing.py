@@ -0,0 +1,115 @@
+from datetime import datetime
+import bibtexparser
+
+# Parsing of BibTeX entries into paper fields, run by the process pool of
+# add_paper_with_bib.py. Nothing here touches the database.
+
+
+def process_authors(authors):
+    # The input is the authors field from a BibTeX entry
+    # first in bib, the first name and the last name is separated by a comma
+    # we want to separate the first name and the last name with just a space
+    # and we want to separate the authors with a comma
+    # Besides, in bib, the family name is placed before the given name
+    # we want to reverse the order of the names
+    # first splice the authors with the "and" and the comma
+    authors_list = authors.split(' and ')
+    for i in range(len(authors_list)):
+        author = authors_list[i]
+        author_name_parts = author.split(', ')
+        if len(author_name_parts) == 1:  # name with {Firstname Lastname} like {Isaac Newton}
+            continue
+        elif len(author_name_parts) == 2:  # name with {Lastname, Firstname} like {Newton, Isaac}
+            author_name_parts.reverse()
+            authors_list[i] = ' '.join(author_name_parts)
+        elif len(author_name_parts) == 3:  # name with {Lastname, Suffix, Firstname} like {Newton, Jr., Isaac}
+            author_name_parts = [author_name_parts[2], author_name_parts[0], author_name_parts[1]]
+            authors_list[i] = ' '.join(author_name_parts)
+    authors = ', '.join(authors_list)
+
+    # sencond, in bib, there are some authors name with special characters
+    # we want to remove these special characters
+    authors = authors.replace('{', '')
+    authors = authors.replace('}', '')
+    # remove the "\" and the command after it
+    authors = authors.replace('\\', '')
+    authors = authors.replace("'", '')
+    authors = authors.replace('"', '')
+    authors = authors.replace('`', '')
+    authors = authors.replace('~', '')
+    authors = authors.replace('^', '')
+    return authors
+
+
+def get_publication_name_with_booktitle(booktitle):
+    # return the publication name from the booktitle
+    # example:
+    # booktitle = "Proceedings of the 2023 ACM SIGSAC Conference on Computer and Communications Security"
+    # return "CCS"
+    if "SIGSAC Conference on Computer and Communications Security" in booktitle:
+        return "CCS"
+    else:
+        raise ValueError("The booktitle is not recognized")
+
+
+def paper_fields_from_entry(entry):
+    """ ResearchPaper columns of a parsed BibTeX entry, raises KeyError or ValueError if it is unusable. """
+    publication_year = entry['year']
+    return {
+        'title': entry['title'],
+        'authors': process_authors(entry['author']),
+        'abstract': entry['abstract'],
+        'publication_date': datetime.strptime(publication_year, "%Y"),  # Convert year to datetime
+        'publication_name': get_publication_name_with_booktitle(entry['booktitle']),
+        'publication_url': entry['url'],
+    }
+
+
+def iter_bib_blocks(bib_file):
+    """ Yield (line number, text) of every @-block of an open .bib file, reading it line by line.
+
+    A block ends when its braces are balanced. A block that is still open when
+    the next line starting with @ arrives is cut there, so one broken entry
+    does not swallow the rest of the file.
+    """
+    block, depth, opened, start_line = [], 0, False, 0
+    for line_number, line in enumerate(bib_file, start=1):
+        if line.startswith('@') and block:
+            yield start_line, ''.join(block)
+            block, depth, opened = [], 0, False
+        if not block:
+            if not line.lstrip().startswith('@'):
+                continue  # text between entries is a comment in BibTeX
+            start_line = line_number
+        block.append(line)
+        opened = opened or '{' in line
+        depth += (line.count('{') - line.count('\\{')) - (line.count('}') - line.count('\\}'))
+        if opened and depth <= 0:
+            yield start_line, ''.join(block)
+            block, depth, opened = [], 0, False
+    if block:
+        yield start_line, ''.join(block)
+
+
+def parse_bib_batch(batch):
+    """ Parse a (string definitions, [(line, text)]) batch of blocks.
+
+    Returns one dict per block, with the `paper` fields, or with the `reason`
+    the block was rejected.
+    """
+    string_definitions, blocks = batch
+    results = []
+    for line, text in blocks:
+        key = None
+        try:
+            library = bibtexparser.parse_string(string_definitions + text)
+            if library.failed_blocks or len(library.entries) != 1:
+                raise ValueError("The entry is malformed")
+            entry = library.entries[0]
+            key = entry.key
+            results.append({'line': line, 'key': key, 'paper': paper_fields_from_entry(entry)})
+        except KeyError as e:
+            results.append({'line': line, 'key': key, 'reason': f"Missing field {e}", 'text': text})
+        except Exception as e:
+            results.append({'line': line, 'key': key, 'reason': str(e), 'text': text})
+    return results
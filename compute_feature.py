@@ -1,19 +1,30 @@
 import time
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
+from sklearn.preprocessing import normalize
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from serve import ResearchPaper, db
+from serve import ResearchPaper, db, read_settings
+from search_index import write_index_version, TFIDF_IDS_FILE
+from match_index import MatchIndex
+from ann_index import ann_available, update_ann_index, measure_recall
+from similar_table import update_similar_table
+from job_runner import file_lock
 import numpy as np
 import tqdm
 from scipy import sparse
 import pickle
 import sys
+import argparse
 
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///papers.db'  # Update to match your configuration
 db.init_app(app)
 
+# Kept between runs to update TF-IDF vectors incrementally
+TFIDF_COUNTS_FILE = 'tfidf_counts.npz'
+TFIDF_STATE_FILE = 'tfidf_state.pkl'
+
 def combine_text_tfidf(paper):
     """ Combine title, authors, and abstract into a single string. """
     return ' '.join([paper.title, paper.authors, paper.abstract])
@@ -22,23 +33,99 @@ def conbine_text_semantic(paper):
     result = "Title: "+paper.title + " Authors: "+paper.authors + " Abstract: "+paper.abstract
     return result
 
-def compute_tfidf_vectors():
+def save_atomic(filename, write):
+    """ Write `filename` with `write(file)` to a temporary file, then replace it. """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as file:
+        write(file)
+    os.replace(tmp_filename, filename)
+    return filename
+
+def compute_idf(df, n_docs):
+    # the smoothed idf TfidfVectorizer uses
+    return np.log((1 + n_docs) / (1 + df)) + 1
+
+def load_tfidf_state():
+    """ Return (state, counts) saved by the last run, (None, None) if there is none. """
+    if not (os.path.exists(TFIDF_STATE_FILE) and os.path.exists(TFIDF_COUNTS_FILE)):
+        return None, None
+    with open(TFIDF_STATE_FILE, 'rb') as file:
+        state = pickle.load(file)
+    return state, sparse.load_npz(TFIDF_COUNTS_FILE).tocsr()
+
+def compute_tfidf_vectors(full_refit=False, drift_threshold=0.05):
+    """ Compute TF-IDF vectors, only new and modified papers are tokenized.
+
+    The vocabulary, document frequencies and raw term counts are kept between
+    runs. The vocabulary is fixed until the share of unknown words in papers
+    added since the last full fit passes `drift_threshold`.
+    """
     with app.app_context():
         start_time = time.time()
-        papers = ResearchPaper.query.all()
-        texts = [combine_text_tfidf(paper) for paper in papers]
-        vectorizer = TfidfVectorizer()
-        tfidf_matrix = vectorizer.fit_transform(texts)
+        # rows of the matrix follow the paper ids, the same order the search index uses
+        papers = ResearchPaper.query.order_by(ResearchPaper.id).all()
+        paper_ids = np.array([paper.id for paper in papers], dtype=np.int64)
+        paper_hashes = {paper.id: compute_hash(paper) for paper in papers}
+        state, counts = (None, None) if full_refit else load_tfidf_state()
+
+        if state is not None:
+            stored_rows = find_rows(state['paper_ids'], paper_ids)
+            changed = [i for i, paper in enumerate(papers)
+                       if stored_rows[i] < 0 or state['hashes'].get(paper.id) != paper_hashes[paper.id]]
+            count_vectorizer = CountVectorizer(vocabulary=state['vocabulary'])
+            texts = [combine_text_tfidf(papers[i]) for i in changed]
+            # words outside the vocabulary are dropped, refit once too many are lost
+            analyzer = count_vectorizer.build_analyzer()
+            for text in texts:
+                tokens = analyzer(text)
+                state['new_tokens'] += len(tokens)
+                state['oov_tokens'] += sum(1 for token in tokens if token not in state['vocabulary'])
+            drift = state['oov_tokens'] / max(state['new_tokens'], 1)
+            print(f"{len(changed)} papers to vectorize, vocabulary drift {drift:.4f}.")
+            if drift > drift_threshold:
+                print(f"Vocabulary drift is above {drift_threshold}, refitting TF-IDF on all papers.")
+                state = None
+            else:
+                new_counts = count_vectorizer.transform(texts)
+                unchanged = np.ones(len(papers), dtype=bool)
+                unchanged[changed] = False
+                removed_rows = np.setdiff1d(np.arange(counts.shape[0]), stored_rows[unchanged])
+                # document frequencies of the removed and re-vectorized rows are replaced
+                vocabulary_size = len(state['vocabulary'])
+                state['df'] = (state['df'] - np.bincount(counts[removed_rows].indices, minlength=vocabulary_size)
+                               + np.bincount(new_counts.indices, minlength=vocabulary_size))
+                selected_rows = stored_rows.copy()
+                selected_rows[changed] = counts.shape[0] + np.arange(len(changed))
+                counts = sparse.vstack([counts, new_counts]).tocsr()[selected_rows]
+
+        if state is None:
+            count_vectorizer = CountVectorizer()
+            counts = count_vectorizer.fit_transform([combine_text_tfidf(paper) for paper in papers]).tocsr()
+            state = {
+                'vocabulary': count_vectorizer.vocabulary_,
+                'df': np.bincount(counts.indices, minlength=len(count_vectorizer.vocabulary_)),
+                'new_tokens': 0,
+                'oov_tokens': 0,
+            }
+        state['paper_ids'] = paper_ids
+        state['hashes'] = paper_hashes
+
+        idf = compute_idf(state['df'], len(papers))
+        tfidf_matrix = normalize(counts @ sparse.diags(idf)).tocsr()
+        vectorizer = TfidfVectorizer(vocabulary=state['vocabulary'])
+        vectorizer.idf_ = idf
         print(f"TF-IDF vectors computed. The shape of the matrix is {tfidf_matrix.shape}.")
         print("The size of the tfidf_matrix variable is:",sys.getsizeof(tfidf_matrix), "bytes.")
-        # Todo: use the papers id as the index of the matrix
 
-        # Saving the sparse matrix instead of dense arrays
-        sparse.save_npz('tfidf_feature_vectors.npz', tfidf_matrix)
+        # Saving the sparse matrix instead of dense arrays, with the paper id of every row
+        # every file is replaced atomically, see write_index_version
+        save_atomic('tfidf_feature_vectors.npz', lambda file: sparse.save_npz(file, tfidf_matrix))
+        save_array(TFIDF_IDS_FILE, paper_ids)
+        save_atomic(TFIDF_COUNTS_FILE, lambda file: sparse.save_npz(file, counts))
+        save_atomic(TFIDF_STATE_FILE, lambda file: pickle.dump(state, file))
 
         # Save the fitted vectorizer
-        with open('tfidf_vectorizer.pkl', 'wb') as file:
-            pickle.dump(vectorizer, file)
+        save_atomic('tfidf_vectorizer.pkl', lambda file: pickle.dump(vectorizer, file))
         print(f"TF-IDF vectors computed and stored in {time.time() - start_time} seconds.")
         print(f"Feature vectors stored in 'tfidf_feature_vectors.npz'. TF-IDF vectorizer stored in 'tfidf_vectorizer.pkl'.")
 
@@ -46,7 +133,13 @@ def compute_tfidf_vectors():
 import hashlib
 import json
 import os
+import uuid
 from sentence_transformers import SentenceTransformer
+from semantic_store import (SEMANTIC_MATRIX_FILE, LEGACY_SEMANTIC_VECTORS_FILE, load_semantic_store,
+                            save_semantic_store, convert_legacy_semantic_vectors, find_rows, save_array)
+
+# Vectors encoded by an unfinished run
+SEMANTIC_CHECKPOINT_DIR = 'semantic_checkpoint'
 
 def compute_hash(paper):
     hasher = hashlib.sha256()
@@ -65,38 +158,176 @@ def save_hashes(hashes, filename='paper_hashes.json'):
         json.dump(hashes, file)
 
 
-def load_semantic_vectors(filename='semantic_vectors.npz'):
-    if os.path.exists(filename):
-        return np.load(filename, allow_pickle=True)['vectors'].item()
-    return {}
+def load_semantic_checkpoint(directory=SEMANTIC_CHECKPOINT_DIR):
+    """ Return {paper_id: (hash, vector)} saved by an interrupted run or by edits, and the part files read. """
+    checkpoint = {}
+    filenames = []
+    if not os.path.isdir(directory):
+        return checkpoint, filenames
+    # part names start with the time they were written, later parts override earlier ones
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.npz'):
+            continue
+        filenames.append(os.path.join(directory, filename))
+        part = np.load(filenames[-1])
+        for pid, paper_hash, vector in zip(part['paper_ids'], part['hashes'], part['vectors']):
+            checkpoint[int(pid)] = (str(paper_hash), vector)
+    return checkpoint, filenames
 
-def load_semantic_vectors(filename='semantic_vectors.npz'):
-    if os.path.exists(filename):
-        return np.load(filename, allow_pickle=True)['vectors'].item()
-    return {}
+def save_semantic_checkpoint(paper_ids, paper_hashes, vectors, directory=SEMANTIC_CHECKPOINT_DIR):
+    # every chunk goes to its own file, so checkpointing cost does not grow with the run. The name
+    # is unique, the server saves the vectors of edited papers here while a run may be writing too
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f"part_{time.time_ns():020d}_{os.getpid()}_{uuid.uuid4().hex}.npz")
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as file:
+        np.savez(file, paper_ids=np.array(paper_ids, dtype=np.int64),
+                 hashes=np.array(paper_hashes, dtype=str), vectors=np.array(vectors, dtype=np.float32))
+    os.replace(tmp_filename, filename)
+    return filename
+
+def compute_semantic_vectors(batch_size=64, num_workers=1, checkpoint_every=20, model=None):
+    """ Embed new and modified papers.
 
-def compute_semantic_vectors():
+    Texts are sorted by length and encoded `batch_size` at a time. After every
+    `checkpoint_every` batches the vectors are saved to a checkpoint file, so an
+    interrupted run resumes where it stopped. With `num_workers` > 1 the batches
+    are encoded by a pool of CPU processes. `model` is an already loaded MiniLM
+    model, e.g. the one of the server.
+    """
     with app.app_context():
-        model = SentenceTransformer('sentence-transformers/all-MiniLM-L12-v2')
-        papers = ResearchPaper.query.all()
+        if model is None:
+            model = SentenceTransformer('sentence-transformers/all-MiniLM-L12-v2')
+        papers = ResearchPaper.query.order_by(ResearchPaper.id).all()
         hashes = load_hashes()
-        semantic_vectors = load_semantic_vectors()
+        if not os.path.exists(SEMANTIC_MATRIX_FILE) and os.path.exists(LEGACY_SEMANTIC_VECTORS_FILE):
+            convert_legacy_semantic_vectors()
+        stored_ids, stored_matrix = load_semantic_store(mmap_mode=None)
+        if stored_ids is None:
+            stored_ids, stored_matrix = np.zeros(0, dtype=np.int64), None
+        stored_rows = find_rows(stored_ids, [paper.id for paper in papers])
+        checkpoint, checkpoint_files = load_semantic_checkpoint()
+        if checkpoint:
+            print(f"Resuming from a checkpoint with {len(checkpoint)} semantic vectors.")
 
-        for paper in tqdm.tqdm(papers):
+        vectors = [None] * len(papers)
+        pending = []  # (row, hash, text) of the papers to encode
+        changed_rows = []
+        for i, paper in enumerate(papers):
             current_hash = compute_hash(paper)
             # Check if paper is modified or semantic vector doesn't exist
-            if hashes.get(str(paper.id)) != current_hash or str(paper.id) not in semantic_vectors:
-                text = conbine_text_semantic(paper)
-                semantic_vectors[str(paper.id)] = model.encode([text])[0]
-                hashes[str(paper.id)] = current_hash
+            if hashes.get(str(paper.id)) != current_hash or stored_rows[i] < 0:
+                changed_rows.append(i)
+                if paper.id in checkpoint and checkpoint[paper.id][0] == current_hash:
+                    vectors[i] = checkpoint[paper.id][1]
+                    hashes[str(paper.id)] = current_hash
+                else:
+                    pending.append((i, current_hash, conbine_text_semantic(paper)))
+            else:
+                vectors[i] = stored_matrix[stored_rows[i]]
+        print(f"{len(pending)} papers to encode.")
 
-        # Save updated hashes and semantic vectors
+        # Similar lengths in a batch means less padding
+        pending.sort(key=lambda item: len(item[2]))
+        pool = model.start_multi_process_pool(target_devices=['cpu'] * num_workers) if num_workers > 1 else None
+        chunk_size = batch_size * checkpoint_every
+        try:
+            with tqdm.tqdm(total=len(pending)) as progress:
+                for chunk_start in range(0, len(pending), chunk_size):
+                    chunk = pending[chunk_start:chunk_start + chunk_size]
+                    texts = [text for _, _, text in chunk]
+                    if pool is not None:
+                        embeddings = model.encode_multi_process(texts, pool, batch_size=batch_size)
+                    else:
+                        embeddings = model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+                    for (i, current_hash, _), embedding in zip(chunk, embeddings):
+                        vectors[i] = embedding
+                        hashes[str(papers[i].id)] = current_hash
+                    checkpoint_files.append(save_semantic_checkpoint([papers[i].id for i, _, _ in chunk],
+                                                                     [h for _, h, _ in chunk], embeddings))
+                    progress.update(len(chunk))
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+
+        # Save updated hashes and semantic vectors, papers removed from the database are dropped
         save_hashes(hashes)
-        np.savez_compressed('semantic_vectors.npz', vectors=semantic_vectors)
+        save_semantic_store([paper.id for paper in papers], np.array(vectors, dtype=np.float32))
+        # only the parts this run read or wrote, the ones saved by edits during the run are used by the next one
+        for filename in checkpoint_files:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        # ids of the papers whose vector changed
+        return [papers[i].id for i in changed_rows]
 
 
-if __name__ == "__main__":
-    compute_tfidf_vectors()
+def compute_ann_index(changed_ids=None):
+    if not ann_available():
+        print("hnswlib is not installed, skipping the ANN index. Install it with 'pip install hnswlib'.")
+        return
+    paper_ids, matrix = load_semantic_store(mmap_mode=None)
+    ann = update_ann_index(paper_ids, matrix, changed_ids)
+    recall = measure_recall(ann, paper_ids, matrix)
+    print(f"ANN index recall@25 against exact search: {recall:.4f}")
+
+def compute_similar_table(changed_ids=None, top_n=25):
+    paper_ids, matrix = load_semantic_store(mmap_mode=None)
+    update_similar_table(paper_ids, matrix, changed_ids, top_n=top_n)
+
+def compute_match_index():
+    with app.app_context():
+        start_time = time.time()
+        papers = db.session.query(ResearchPaper.id, ResearchPaper.title, ResearchPaper.authors,
+                                  ResearchPaper.abstract).order_by(ResearchPaper.id).all()
+        match_index = MatchIndex.build(papers)
+        match_index.save()
+        print(f"Match index of {len(papers)} papers computed and stored in {time.time() - start_time} seconds.")
+
+
+def compute_features(full_refit=False, drift_threshold=0.05, ann=False, similar_table=False, batch_size=64,
+                     num_workers=1, checkpoint_every=20, model=None, progress=None):
+    """ Update all the feature artifacts, then publish them to the server.
+
+    Every artifact is replaced atomically and the version stamp is written last,
+    so a running server keeps searching the previous features until all the new
+    ones are in place. `progress(step)` is called when a step starts.
+    """
+    progress = progress or (lambda step: None)
+    progress('tfidf')
+    compute_tfidf_vectors(full_refit=full_refit, drift_threshold=drift_threshold)
     print("TF-IDF feature vectors computed and stored.")
-    compute_semantic_vectors()
-    print("Semantic feature vectors computed and stored.")
\ No newline at end of file
+    progress('semantic')
+    changed_ids = compute_semantic_vectors(batch_size=batch_size, num_workers=num_workers,
+                                           checkpoint_every=checkpoint_every, model=model)
+    print("Semantic feature vectors computed and stored.")
+    settings = read_settings()
+    if ann or settings.get('similar_search_backend', 'exact') == 'hnsw':
+        progress('ann')
+        compute_ann_index(changed_ids)
+    if similar_table or settings.get('precompute_similar', False):
+        progress('similar_table')
+        compute_similar_table(changed_ids, top_n=settings['number_of_similar_papers'])
+    progress('match')
+    compute_match_index()
+    # let the running server know that a complete set of features is available
+    write_index_version()
+    return {'changed_papers': len(changed_ids)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute TF-IDF and semantic feature vectors for the papers in the database.')
+    parser.add_argument('--full_refit', action='store_true', help='Refit the TF-IDF vocabulary on all papers')
+    parser.add_argument('--drift_threshold', type=float, default=0.05, help='Share of unknown words that triggers a TF-IDF refit')
+    parser.add_argument('--ann', action='store_true', help='Build the HNSW index for similar papers even if it is not enabled in the settings')
+    parser.add_argument('--similar_table', action='store_true', help='Precompute the similar papers of every paper even if it is not enabled in the settings')
+    parser.add_argument('--batch_size', type=int, default=64, help='Number of papers encoded in one batch')
+    parser.add_argument('--workers', type=int, default=1, help='Number of CPU processes used to encode papers')
+    parser.add_argument('--checkpoint_every', type=int, default=20, help='Save the semantic vectors every N batches')
+    args = parser.parse_args()
+
+    with file_lock():
+        compute_features(full_refit=args.full_refit, drift_threshold=args.drift_threshold, ann=args.ann,
+                         similar_table=args.similar_table, batch_size=args.batch_size, num_workers=args.workers,
+                         checkpoint_every=args.checkpoint_every)
\ No newline at end of file
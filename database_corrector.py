@@ -1,6 +1,13 @@
+import argparse
+import json
+import re
+import time
+import zlib
+import numpy as np
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from serve import ResearchPaper, db  # Adjust the import as necessary
+from serve import ResearchPaper, db, mark_papers_deleted  # Adjust the import as necessary
+from semantic_store import load_semantic_store, find_rows
 import unicodedata
 
 def normalize_authors(authors_str):
@@ -12,13 +19,29 @@ app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///papers.db"
 db.init_app(app)
 
+# Near-duplicate detection: titles are compared by their character 5-grams. 128 MinHash values
+# in 16 bands of 8 make pairs above about 0.7 Jaccard similarity candidates
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+LSH_BANDS = 16
+MERSENNE_PRIME = (1 << 31) - 1
+TITLE_THRESHOLD = 0.8
+AUTHOR_THRESHOLD = 0.5
+# shorter titles, e.g. "Introduction", are too generic to tell duplicates apart
+MIN_TITLE_WORDS = 4
+MERGE_PLAN_FILE = 'merge_plan.json'
+
 def correct_paper_titles():
     with app.app_context():
         papers = ResearchPaper.query.all()
+        # (title, authors) -> paper, instead of one query per paper ending in a dot
+        papers_by_key = {}
+        for paper in papers:
+            papers_by_key.setdefault((paper.title, paper.authors), paper)
         for paper in papers:
             if paper.title.endswith('.'):
                 corrected_title = paper.title.rstrip('.')
-                duplicate_paper = ResearchPaper.query.filter_by(title=corrected_title, authors=paper.authors).first()
+                duplicate_paper = papers_by_key.get((corrected_title, paper.authors))
 
                 if duplicate_paper:
                     # Copy current entry's publication info to the existing entry and delete the current entry
@@ -28,8 +51,10 @@ def correct_paper_titles():
                     # Update the current entry to remove the dot from the title
                     paper.title = corrected_title
                     db.session.add(paper)
+                    papers_by_key[(corrected_title, paper.authors)] = paper
 
         db.session.commit()
+    mark_papers_deleted()
 
 def update_publication_info(existing_paper, current_paper):
     existing_paper.publication_name = current_paper.publication_name
@@ -74,6 +99,185 @@ def merge_duplicates(duplicates):
 
             db.session.add(primary_paper)
         db.session.commit()
+    mark_papers_deleted()
+
+def normalize_title(title):
+    """ Lower-cased title without accents, punctuation and repeated spaces. """
+    title = normalize_authors(title).lower()
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', title).split())
+
+
+def title_shingles(title, k=SHINGLE_SIZE):
+    """ Hashes of the character k-grams of the normalised title. """
+    title = normalize_title(title)
+    if len(title) <= k:
+        return {zlib.crc32(title.encode())}
+    return {zlib.crc32(title[i:i + k].encode()) for i in range(len(title) - k + 1)}
+
+
+def minhash_signatures(shingle_sets, num_perm=NUM_PERM, seed=0):
+    """ MinHash signature (num_perm values) of every shingle set, (a * x + b) mod p hash family. """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(shingle_sets), num_perm), dtype=np.uint64)
+    for i, shingles in enumerate(shingle_sets):
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        signatures[i] = ((a[:, None] * hashes[None, :] + b[:, None]) % MERSENNE_PRIME).min(axis=1)
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=LSH_BANDS, max_bucket_size=50):
+    """ Pairs of rows whose signatures agree on all rows of at least one band.
+
+    Every signature is hashed once per band, so this is linear in the number of
+    papers. Very large buckets (e.g. very short, generic titles) are skipped.
+    """
+    rows_per_band = signatures.shape[1] // bands
+    pairs = set()
+    for band in range(bands):
+        buckets = {}
+        band_values = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        for row, value in enumerate(band_values):
+            buckets.setdefault(value.tobytes(), []).append(row)
+        for bucket in buckets.values():
+            if 1 < len(bucket) <= max_bucket_size:
+                pairs.update((bucket[i], bucket[j]) for i in range(len(bucket)) for j in range(i + 1, len(bucket)))
+    return pairs
+
+
+def title_numbers(words):
+    """ The numbers in the words of a normalised title, e.g. the part of a series. """
+    return [word for word in words if word.isdigit()]
+
+
+def author_surnames(authors):
+    # DBLP tells homonyms apart with a number after the name, e.g. "Carol Wu 0001"
+    names = [[part for part in name.split() if not part.isdigit()] for name in normalize_authors(authors).lower().split(',')]
+    return {name[-1] for name in names if name}
+
+
+def find_near_duplicates(title_threshold=TITLE_THRESHOLD, author_threshold=AUTHOR_THRESHOLD, semantic_threshold=None):
+    """ Groups of papers with nearly the same title and authors, as lists of paper ids.
+
+    Candidates come from MinHash/LSH over title shingles and are confirmed with
+    the exact shingle Jaccard similarity, the Jaccard similarity of the author
+    surnames and, with a `semantic_threshold`, the cosine similarity of their
+    semantic vectors. Every paper of a group is confirmed against the primary
+    paper of the group, not only against some other member. Titles shorter than
+    MIN_TITLE_WORDS words and titles with different numbers (e.g. "Part 1" and
+    "Part 2") are never grouped.
+    """
+    with app.app_context():
+        papers = db.session.query(ResearchPaper.id, ResearchPaper.title, ResearchPaper.authors,
+                                  ResearchPaper.arxiv_id).order_by(ResearchPaper.id).all()
+    start_time = time.time()
+    paper_ids = np.array([paper.id for paper in papers], dtype=np.int64)
+    titles = [normalize_title(paper.title).split() for paper in papers]
+    shingle_sets = [title_shingles(paper.title) for paper in papers]
+    candidate_pairs = lsh_candidate_pairs(minhash_signatures(shingle_sets))
+    print(f"{len(candidate_pairs)} candidate pairs among {len(papers)} papers in {time.time() - start_time} seconds.")
+
+    semantic_ids, semantic_matrix = load_semantic_store() if semantic_threshold is not None else (None, None)
+    if semantic_threshold is not None and semantic_ids is None:
+        print("No semantic vectors found, duplicates are not confirmed with them.")
+
+    def is_duplicate(i, j):
+        if len(titles[i]) < MIN_TITLE_WORDS or len(titles[j]) < MIN_TITLE_WORDS:
+            return False
+        if title_numbers(titles[i]) != title_numbers(titles[j]):
+            return False
+        shingles_i, shingles_j = shingle_sets[i], shingle_sets[j]
+        if len(shingles_i & shingles_j) / len(shingles_i | shingles_j) < title_threshold:
+            return False
+        surnames_i, surnames_j = author_surnames(papers[i].authors), author_surnames(papers[j].authors)
+        if surnames_i and surnames_j and len(surnames_i & surnames_j) / len(surnames_i | surnames_j) < author_threshold:
+            return False
+        if semantic_ids is not None:
+            rows = find_rows(semantic_ids, paper_ids[[i, j]])
+            if (rows >= 0).all() and float(semantic_matrix[rows[0]] @ semantic_matrix[rows[1]]) < semantic_threshold:
+                return False
+        return True
+
+    # connected components of the confirmed pairs, only used to find the papers to compare to a primary
+    parents = list(range(len(papers)))
+
+    def find(row):
+        while parents[row] != row:
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+        return row
+
+    for i, j in candidate_pairs:
+        if is_duplicate(i, j):
+            parents[find(i)] = find(j)
+
+    components = {}
+    for row in range(len(papers)):
+        components.setdefault(find(row), []).append(row)
+    groups = []
+    for rows in components.values():
+        # the primary paper is chosen like in write_merge_plan: the arXiv version, otherwise the oldest
+        rows.sort(key=lambda row: (papers[row].arxiv_id is None, papers[row].id))
+        while len(rows) > 1:
+            primary, others = rows[0], rows[1:]
+            group = [primary] + [row for row in others if is_duplicate(primary, row)]
+            if len(group) > 1:
+                groups.append(sorted(int(paper_ids[row]) for row in group))
+            rows = [row for row in others if row not in group]
+    return groups
+
+
+def write_merge_plan(groups, plan_path=MERGE_PLAN_FILE):
+    """ Write the duplicate groups as a merge plan to review, and edit, before applying it.
+
+    The primary paper of a group is kept. It is the arXiv version if there is
+    one, so later arXiv fetches still find it, otherwise the oldest entry.
+    """
+    with app.app_context():
+        plan = []
+        for group in groups:
+            papers = sorted(ResearchPaper.query.filter(ResearchPaper.id.in_(group)).all(),
+                            key=lambda paper: (paper.arxiv_id is None, paper.id))
+            plan.append({
+                'primary': papers[0].id,
+                'duplicates': [paper.id for paper in papers[1:]],
+                'papers': [{'id': paper.id, 'title': paper.title, 'authors': paper.authors, 'arxiv_id': paper.arxiv_id,
+                            'publication_name': paper.publication_name} for paper in papers],
+            })
+    with open(plan_path, 'w') as file:
+        json.dump(plan, file, indent=4)
+    print(f"Merge plan with {len(plan)} groups written to {plan_path}.")
+    return plan
+
+
+def apply_merge_plan(plan_path=MERGE_PLAN_FILE):
+    """ Merge every group of the plan into its primary paper, like merge_duplicates, in one transaction. """
+    with open(plan_path, 'r') as file:
+        plan = json.load(file)
+    with app.app_context():
+        ids = [paper_id for group in plan for paper_id in [group['primary']] + group['duplicates']]
+        papers = {}
+        for start in range(0, len(ids), 500):
+            papers.update((paper.id, paper) for paper in ResearchPaper.query.filter(ResearchPaper.id.in_(ids[start:start + 500])))
+        merged = 0
+        for group in plan:
+            primary_paper = papers.get(group['primary'])
+            if primary_paper is None:
+                print(f"Paper {group['primary']} no longer exists, skipping its group.")
+                continue
+            for duplicate_id in group['duplicates']:
+                duplicate = papers.get(duplicate_id)
+                if duplicate is None or duplicate is primary_paper:
+                    continue
+                # Merge information from duplicate into primary_paper
+                merge_publication_info(primary_paper, duplicate)
+                db.session.delete(duplicate)
+                merged += 1
+        db.session.commit()
+    mark_papers_deleted()
+    print(f"Merged {merged} duplicates.")
+
 
 def clean_abstract_and_title():
     with app.app_context():
@@ -90,5 +294,21 @@ def clean_abstract_and_title():
 
 
 if __name__ == "__main__":
-    clean_abstract_and_title()
-    print("Database data cleanup complete.")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Clean up the papers in the database.")
+    parser.add_argument("--near_duplicates", action="store_true",
+                        help="Find papers with nearly the same title and authors and write a merge plan")
+    parser.add_argument("--apply_plan", action="store_true", help="Merge the duplicates listed in the merge plan")
+    parser.add_argument("--plan", type=str, default=MERGE_PLAN_FILE, help="Merge plan file")
+    parser.add_argument("--title_threshold", type=float, default=TITLE_THRESHOLD,
+                        help="Minimum Jaccard similarity of the title shingles")
+    parser.add_argument("--semantic_threshold", type=float, default=None,
+                        help="Also require this cosine similarity of the semantic vectors, e.g. 0.9")
+    args = parser.parse_args()
+
+    if args.near_duplicates:
+        write_merge_plan(find_near_duplicates(args.title_threshold, semantic_threshold=args.semantic_threshold), args.plan)
+    elif args.apply_plan:
+        apply_merge_plan(args.plan)
+    else:
+        clean_abstract_and_title()
+        print("Database data cleanup complete.")
\ No newline at end of file
@@ -1,16 +1,16 @@
-import requests
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import argparse
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import tuple_
 from serve import ResearchPaper, db  # Adjust the import as necessary
 import time
 from datetime import datetime
-from bs4.element import NavigableString
 import unicodedata
-import random
 import tqdm
-import bibtexparser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import http_client
+from abstract_extractors import get_abstract, make_soup, has_class, EXTRACTORS
 
 def normalize_authors(authors_str):
     normalized_authors = unicodedata.normalize('NFKD', authors_str)
@@ -20,132 +20,47 @@ app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///papers.db"
 db.init_app(app)
 
-Implemented_Conferences_Journals = [
-    "NDSS", "USENIX Security", "ICML"
-]  # all the implemented conferences and journals are listed here
+# abstracts are fetched by this many threads, http_client keeps the requests to each host within its rate limit
+DEFAULT_WORKERS = 8
+# (title, authors) pairs looked up per query, SQLite allows 999 parameters
+LOOKUP_CHUNK_SIZE = 400
 
-def get_abstract(publication_name, publication_url):
-    if publication_name == "NDSS":
-        return get_abstract_ndss(publication_url)
-    elif publication_name == "USENIX Security":
-        return get_abstract_usenix_security(publication_url)
-    elif publication_name == "ICML":
-        return get_abstract_icml(publication_url)
-    else:
-        print("Publication not implemented yet!")
-        return ""  # Not implemented yet
+# all the implemented conferences and journals, see abstract_extractors.py to add one
+Implemented_Conferences_Journals = list(EXTRACTORS)
 
 
-def get_abstract_ndss(publication_url, debug=False):
-    try:
-        start_time = time.time()
-        response = requests.get(publication_url)
-        response.raise_for_status()  # Check that the request was successful
-        if debug:
-            print("Time taken for request: {:.2f} seconds".format(time.time() - start_time))
-        start_time = time.time()
-        soup = BeautifulSoup(response.text, "html.parser")
-        main_content = soup.find("div", class_="paper-data")
-        if debug:
-            print("Time taken for parsing: {:.2f} seconds".format(time.time() - start_time))
-        if not main_content:
-            print(f"Page parsed and abstract is not found for {publication_url}")
-            return "Abstract not found"
-
-        abstract_paragraphs = main_content.find_all("p")
-        # remove the paragraph that contains the title
-        abstract_paragraphs = abstract_paragraphs[2:]
-        abstract_text = []
-
-        for paragraph in abstract_paragraphs:
-            for content in paragraph.contents:
-                if isinstance(content, NavigableString):
-                    abstract_text.append(content.strip())
-                elif content.name == "br":
-                    abstract_text.append(" ")  # Replace <br> with space
-
-        return " ".join(abstract_text).strip()
-    except requests.RequestException as e:
-        print(f"Error fetching the page: {e}")
-        return None
-    except Exception as e:
-        print(f"Error parsing the page: {e}")
-        return None
-
-def get_abstract_usenix_security(publication_url, debug=False):
-    try:
-        start_time = time.time()
-        response = requests.get(publication_url)
-        response.raise_for_status()  # Check that the request was successful
-        if debug:
-            print("Time taken for request: {:.2f} seconds".format(time.time() - start_time))
-        start_time = time.time()
-        soup = BeautifulSoup(response.text, "html.parser")
-        main_content = soup.find("div", class_="field field-name-field-paper-description field-type-text-long field-label-above")
-        if debug:
-            print("Time taken for parsing: {:.2f} seconds".format(time.time() - start_time))
-        if not main_content:
-            print(f"Page parsed and abstract is not found for {publication_url}")
-            return "Abstract not found"
-
-        abstract_paragraphs = main_content.find_all("p")
-        abstract_text = []
-
-        for paragraph in abstract_paragraphs:
-            for content in paragraph.contents:
-                if isinstance(content, NavigableString):
-                    abstract_text.append(content.strip())
-                elif content.name == "br":
-                    abstract_text.append(" ")  # Replace <br> with space
-
-        return " ".join(abstract_text).strip()
-    except requests.RequestException as e:
-        print(f"Error fetching the page: {e}")
-        return None
-    except Exception as e:
-        print(f"Error parsing the page: {e}")
-        return None
-
-
-def get_abstract_icml(publication_url, debug=False):
-    # for IMCL, the abstract can be found in the bibtex in the HTML, we parse the bibtex and get the abstract
-    try:
-        start_time = time.time()
-        response = requests.get(publication_url)
-        response.raise_for_status()  # Check that the request was successful
-        if debug:
-            print("Time taken for request: {:.2f} seconds".format(time.time() - start_time))
-        start_time = time.time()
-        soup = BeautifulSoup(response.text, "html.parser")
-        bibtex_element = soup.find("code", id="bibtex")
-        if debug:
-            print("Time taken for parsing: {:.2f} seconds".format(time.time() - start_time))
-        if not bibtex_element:
-            print(f"Page parsed and abstract is not found for {publication_url}")
-            return "Abstract not found"
-        bibtex_text = bibtex_element.text
-        library = bibtexparser.parse_string(bibtex_text)
-        abstract_text = library.entries[0]['abstract']
-        return abstract_text
-    except requests.RequestException as e:
-        print(f"Error fetching the page: {e}")
-        return None
-    except Exception as e:
-        print(f"Error parsing the page: {e}")
-        return None
-
-
-
-def fetch_dblp_papers(dblp_url, publication_name, publication_year):
+def fetch_abstracts(publication_name, publication_urls, workers=DEFAULT_WORKERS):
+    """ {url: abstract} of the papers, fetched concurrently within the per-host rate limit. """
+    abstracts = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(get_abstract, publication_name, url): url for url in publication_urls}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            abstracts[futures[future]] = future.result()
+    return abstracts
+
+
+def find_existing_papers(keys):
+    """ {(title, authors): paper} of the papers already in the database, with batched lookups. """
+    existing_papers = {}
+    keys = list(keys)
+    for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+        for paper in ResearchPaper.query.filter(tuple_(ResearchPaper.title, ResearchPaper.authors).in_(chunk)):
+            existing_papers.setdefault((paper.title, paper.authors), paper)
+    return existing_papers
+
+
+def fetch_dblp_papers(dblp_url, publication_name, publication_year, workers=DEFAULT_WORKERS):
     with app.app_context():
         start_time = time.time()
         print(f"Fetching papers from DBLP URL: {dblp_url}")
-        response = requests.get(dblp_url)
+        response = http_client.get(dblp_url)
         # response = requests.get("https://dblp.org/db/conf/ndss/ndss2023.html")
         print("Time taken for request: {:.2f} seconds".format(time.time() - start_time))
         print(f"Response status code: {response.status_code}")
         start_time = time.time()
-        soup = BeautifulSoup(response.text, "html.parser")
+        # only the paper entries of the listing are built
+        soup = make_soup(response.text, SoupStrainer("li", class_=has_class("inproceedings")))
         print("Time taken for parsing: {:.2f} seconds".format(time.time() - start_time))
         publication_date = datetime.strptime(
             publication_year, "%Y"
@@ -153,12 +68,8 @@ def fetch_dblp_papers(dblp_url, publication_name, publication_year):
         print(
             f"The Publication date used default date of {publication_year}: {publication_date}"
         )
-        total_paper_counter = 0
-        new_paper_counter = 0
-        updated_paper_counter = 0
-        # for paper_li in soup.find_all("li", class_="entry inproceedings"):
-        for paper_li in tqdm.tqdm(soup.find_all("li", class_="entry inproceedings")):
-            total_paper_counter += 1
+        papers = {}
+        for paper_li in soup.find_all("li", class_="entry inproceedings"):
             title = paper_li.find("span", class_="title").text.strip()
             # title may ended with a unnecessary dot
             if title.endswith("."):
@@ -168,18 +79,30 @@ def fetch_dblp_papers(dblp_url, publication_name, publication_year):
                 for author_span in paper_li.find_all("span", itemprop="author")
             ]
             publication_url = paper_li.find("a", itemprop="url")["href"]
-
             authors_str = ", ".join(authors)
+            # a paper listed twice in the page is added once
+            papers.setdefault((title, authors_str), publication_url)
+        # check which papers already exist, one query per chunk of papers
+        existing_papers = find_existing_papers(papers)
+        papers = [(title, authors_str, publication_url, existing_papers.get((title, authors_str)))
+                  for (title, authors_str), publication_url in papers.items()]
+
+        # get abstracts if the publication is implemented, papers that have one are skipped
+        abstracts = {}
+        if publication_name in Implemented_Conferences_Journals:
+            to_fetch = [publication_url for _, _, publication_url, existing_paper in papers
+                        if existing_paper is None or not existing_paper.abstract]
+            print(f"Fetching {len(to_fetch)} abstracts, {len(papers) - len(to_fetch)} papers already have one.")
+            start_time = time.time()
+            abstracts = fetch_abstracts(publication_name, to_fetch, workers)
+            print("Time taken for fetching abstracts: {:.2f} seconds".format(time.time() - start_time))
 
-            # get abstract if the publication is implemented
-            if publication_name in Implemented_Conferences_Journals:
-                abstract = get_abstract(publication_name, publication_url)  # TODO: add handler function
-            else:
-                abstract = ""
-            # check if the paper already exists
-            existing_paper = ResearchPaper.query.filter_by(
-                title=title, authors=authors_str
-            ).first()
+        total_paper_counter = 0
+        new_paper_counter = 0
+        updated_paper_counter = 0
+        for title, authors_str, publication_url, existing_paper in papers:
+            total_paper_counter += 1
+            abstract = abstracts.get(publication_url, "")
             if total_paper_counter < 3:
                 print(
                     f"Debug: \nTitle: {title}\nAuthors: {authors_str}\nPublication URL: {publication_url}\n Exsiting Paper: {existing_paper}\n Abstract: {abstract}"
@@ -204,8 +127,6 @@ def fetch_dblp_papers(dblp_url, publication_name, publication_year):
                 )
                 new_paper_counter += 1
                 db.session.add(new_paper)
-                # Random delay between requests
-            time.sleep(random.uniform(1.0, 5.0))
         print(
             f"Total papers fetched: {total_paper_counter}\nNew papers added: {new_paper_counter}\nExisting papers updated: {updated_paper_counter}"
         )
@@ -244,10 +165,29 @@ if __name__ == "__main__":
         help="Publication name (conference/journal abbreviation)",
     )
     parser.add_argument("--year", type=str, required=True, help="Publication year")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Threads fetching abstracts")
+    parser.add_argument(
+        "--rate", type=float, default=http_client.DEFAULT_RATE, help="Requests per second to each host"
+    )
+
+    parser.add_argument(
+        "--cache_ttl", type=float, default=http_client.DEFAULT_CACHE_TTL / 3600,
+        help="Hours before a cached page is revalidated with the server",
+    )
+    parser.add_argument("--no_cache", action="store_true", help="Do not use the page cache")
+    parser.add_argument(
+        "--offline", action="store_true", help="Only replay pages from the cache, e.g. to test abstract parsing"
+    )
 
     args = parser.parse_args()
 
-    fetch_dblp_papers(args.url, args.name, args.year)
+    http_client.configure(
+        rate=args.rate,
+        cache_dir=None if args.no_cache else http_client.HTTP_CACHE_DIR,
+        cache_ttl=args.cache_ttl * 3600,
+        offline=args.offline,
+    )
+    fetch_dblp_papers(args.url, args.name, args.year, args.workers)
     print(
         f"Fetched papers from DBLP URL: {args.url} in {time.time() - start_time} seconds."
     )
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Politeness budget: at most DEFAULT_RATE requests per second to every host, with
+# short bursts of DEFAULT_BURST requests
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 2
+DEFAULT_TIMEOUT = 30
+# 429 and 5xx responses are retried with exponential backoff (1, 2, 4, ... seconds),
+# a Retry-After header is respected
+RETRY = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+              allowed_methods=['GET', 'HEAD'], respect_retry_after_header=True, raise_on_status=False)
+
+# Fetched pages are kept on disk, so re-running an import does not download them again
+HTTP_CACHE_DIR = 'http_cache'
+DEFAULT_CACHE_TTL = 7 * 24 * 3600
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# headers kept with a cached page, the validators and what decoding the body needs
+CACHED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+
+class OfflineCacheMiss(requests.ConnectionError):
+    """ The page is not cached and the network may not be used. """
+
+
+class HttpCache:
+    """ Disk cache of successful GET responses.
+
+    Bodies are stored once per content hash in `objects/`, and `index/` maps the
+    hash of every URL to its body, headers and fetch time. Entries older than
+    `ttl` seconds are revalidated with their ETag or Last-Modified header. The
+    least recently used entries are evicted when the bodies exceed `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, ttl=DEFAULT_CACHE_TTL, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _index_path(self, url):
+        return os.path.join(self.cache_dir, 'index', hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest)
+
+    def lookup(self, url):
+        """ Return (meta, body) of the cached page, or None. """
+        index_path = self._index_path(url)
+        try:
+            with open(index_path, 'r') as file:
+                meta = json.load(file)
+            with open(self._object_path(meta['digest']), 'rb') as file:
+                body = file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        # the modification time of an index file is its last use
+        os.utime(index_path)
+        return meta, body
+
+    def is_fresh(self, meta):
+        return time.time() - meta['fetched_at'] < self.ttl
+
+    def store(self, url, response):
+        digest = hashlib.sha256(response.content).hexdigest()
+        meta = {
+            'url': url,
+            'digest': digest,
+            'fetched_at': time.time(),
+            'encoding': response.encoding,
+            'headers': {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers},
+        }
+        object_path = self._object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.makedirs(os.path.dirname(self._index_path(url)), exist_ok=True)
+        added = 0
+        if not os.path.exists(object_path):
+            write_atomic(object_path, response.content)
+            added = len(response.content)
+        self.touch(url, meta)
+        with self.lock:
+            if self.size is None:
+                self.size = self._object_sizes_total()
+            else:
+                self.size += added
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def touch(self, url, meta):
+        """ Write the index entry of `url`, e.g. with a new fetch time after a revalidation. """
+        write_atomic(self._index_path(url), json.dumps(meta).encode())
+
+    def _object_sizes_total(self):
+        objects_dir = os.path.join(self.cache_dir, 'objects')
+        return sum(entry.stat().st_size for entry in os.scandir(objects_dir)) if os.path.isdir(objects_dir) else 0
+
+    def _evict(self):
+        """ Drop the least recently used entries until the bodies fit in `max_bytes`. """
+        index_dir = os.path.join(self.cache_dir, 'index')
+        entries = sorted(os.scandir(index_dir), key=lambda entry: entry.stat().st_mtime)
+        digests = {}
+        for entry in entries:
+            try:
+                with open(entry.path, 'r') as file:
+                    digests[entry.path] = json.load(file)['digest']
+            except (OSError, ValueError, KeyError):
+                digests[entry.path] = None
+        references = {}
+        for digest in digests.values():
+            references[digest] = references.get(digest, 0) + 1
+        for entry in entries:
+            if self.size <= self.max_bytes:
+                break
+            digest = digests[entry.path]
+            os.remove(entry.path)
+            references[digest] -= 1
+            if digest is not None and references[digest] == 0 and os.path.exists(self._object_path(digest)):
+                self.size -= os.path.getsize(self._object_path(digest))
+                os.remove(self._object_path(digest))
+
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def cached_response(url, meta, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    response.encoding = meta['encoding']
+    response.headers.update(meta['headers'])
+    response.from_cache = True
+    return response
+
+
+_session = None
+_buckets = {}
+_rate = DEFAULT_RATE
+_burst = DEFAULT_BURST
+_cache = HttpCache()
+_offline = False
+_lock = threading.Lock()
+
+
+class TokenBucket:
+    """ Allows `rate` requests per second on average and bursts of `capacity` requests. """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request may be sent. """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def configure(rate=DEFAULT_RATE, burst=DEFAULT_BURST, cache_dir=HTTP_CACHE_DIR, cache_ttl=DEFAULT_CACHE_TTL,
+              cache_max_bytes=DEFAULT_CACHE_MAX_BYTES, offline=False):
+    """ Change the per-host rate limit and the page cache, `cache_dir=None` disables the cache.
+
+    In `offline` mode pages are only replayed from the cache, whatever their age,
+    and a page that is not cached raises OfflineCacheMiss.
+    """
+    global _rate, _burst, _cache, _offline
+    with _lock:
+        _rate, _burst = rate, burst
+        _buckets.clear()
+        _cache = HttpCache(cache_dir, cache_ttl, cache_max_bytes) if cache_dir else None
+        _offline = offline
+
+
+def get_session(pool_size=16):
+    """ Session shared by all threads, connections to a host are kept alive and reused. """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=RETRY)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_bucket(host):
+    with _lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(_rate, _burst)
+        return _buckets[host]
+
+
+def get(url, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """ GET `url` through the page cache and the shared session.
+
+    Only requests that go to the network wait for the rate limit of their host.
+    """
+    cache, offline = _cache, _offline
+    cached = cache.lookup(url) if cache is not None else None
+    if cached is not None and (offline or cache.is_fresh(cached[0])):
+        return cached_response(url, *cached)
+    if offline:
+        raise OfflineCacheMiss(f"{url} is not in the cache")
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if cached is not None:
+        # revalidate the stale page, the server answers 304 if it did not change
+        meta = cached[0]
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+    get_bucket(urlparse(url).netloc).acquire()
+    response = get_session().get(url, timeout=timeout, headers=headers, **kwargs)
+    if cached is not None and response.status_code == 304:
+        meta['fetched_at'] = time.time()
+        cache.touch(url, meta)
+        return cached_response(url, *cached)
+    if cache is not None and response.status_code == 200:
+        cache.store(url, response)
+    return response
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# finished jobs kept for the status endpoint
+JOB_HISTORY_SIZE = 20
+# held while a job runs, so the jobs of several server processes (e.g. gunicorn
+# workers) and compute_feature.py never work on the feature files at the same time
+JOB_LOCK_FILE = 'jobs.lock'
+
+
+@contextmanager
+def file_lock(filename=JOB_LOCK_FILE):
+    """ Exclusive lock shared by all processes, waits until it is free. """
+    with open(filename, 'a+') as file:
+        if os.name == 'nt':
+            while True:
+                try:
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class Job:
+    def __init__(self, job_id, name):
+        self.id = job_id
+        self.name = name
+        self.state = 'queued'
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # times the job was requested while it was waiting, e.g. several edits
+        self.requests = 1
+        self.step = None
+        # {step: seconds} of the finished steps
+        self.timings = OrderedDict()
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'requests': self.requests,
+            'step': self.step,
+            'timings': dict(self.timings),
+            'queued_for': (self.started_at or now) - self.submitted_at,
+            'running_for': (self.finished_at or now) - self.started_at if self.started_at else None,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobRunner:
+    """ Runs the registered jobs one at a time in a background thread.
+
+    A job submitted while the same job is still waiting is merged into the
+    waiting one. A job submitted while it is running is queued again, so the
+    changes made during the run are picked up by the next one. Job functions
+    receive a `progress(step)` callback, which times the steps of the job.
+
+    Every process has its own runner, a job holds the `lock_file` while it runs,
+    so the jobs of other processes wait for it (their step is 'waiting').
+    """
+
+    def __init__(self, history_size=JOB_HISTORY_SIZE, lock_file=JOB_LOCK_FILE):
+        self.jobs = {}
+        self.lock_file = lock_file
+        self.history_size = history_size
+        self.queue = []
+        self.history = []
+        self.current = None
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def register(self, name, function):
+        self.jobs[name] = function
+
+    def submit(self, name):
+        """ Queue the job `name`, return the queued (or merged) Job. """
+        if name not in self.jobs:
+            raise KeyError(f"Unknown job {name}")
+        with self.condition:
+            for job in self.queue:
+                if job.name == name:
+                    job.requests += 1
+                    return job
+            job = Job(self.next_id, name)
+            self.next_id += 1
+            self.queue.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, name='job-runner', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return job
+
+    def status(self):
+        with self.condition:
+            return {
+                'running': self.current.to_dict() if self.current else None,
+                'queued': [job.to_dict() for job in self.queue],
+                'finished': [job.to_dict() for job in reversed(self.history)],
+            }
+
+    def is_busy(self):
+        with self.condition:
+            return self.current is not None or bool(self.queue)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.current = self.queue.pop(0)
+                job.state = 'running'
+                job.started_at = time.time()
+            print(f"Job {job.name} #{job.id} started.")
+            step_started = [job.started_at]
+
+            def progress(step):
+                now = time.time()
+                if job.step is not None:
+                    job.timings[job.step] = now - step_started[0]
+                job.step, step_started[0] = step, now
+
+            try:
+                progress('waiting')
+                with file_lock(self.lock_file):
+                    job.result = self.jobs[job.name](progress)
+                job.state = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.state = 'failed'
+            progress(None)
+            job.finished_at = time.time()
+            print(f"Job {job.name} #{job.id} {job.state} in {job.finished_at - job.started_at} seconds.")
+            with self.condition:
+                self.current = None
+                self.history.append(job)
+                del self.history[:-self.history_size]
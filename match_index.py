@@ -0,0 +1,91 @@
+import os
+import pickle
+from collections import Counter
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from semantic_store import find_rows
+
+MATCH_INDEX_FILE = 'match_index.pkl'
+# Same weighting as the original match search (from arxiv-sanity-lite): a query word
+# scores 20 if it is in the title, 10 if it is in the authors, and its count in the abstract
+MATCH_FIELDS = ['title', 'authors', 'abstract']
+TITLE_WEIGHT = 20
+AUTHORS_WEIGHT = 10
+
+
+class MatchIndex:
+    """ Inverted index of the lower-cased, whitespace separated words of each field.
+
+    For every field, `postings[field]` is a (vocabulary, matrix) pair where row
+    `vocabulary[word]` of the CSR matrix holds the papers (as rows of
+    `paper_ids`) containing the word and the word counts. Papers edited since
+    the index was built are scored from `overrides` instead, see patch.
+    """
+
+    def __init__(self, paper_ids, postings):
+        self.paper_ids = paper_ids
+        self.postings = postings
+        # {row: {field: Counter of its words}}
+        self.overrides = {}
+
+    @classmethod
+    def build(cls, papers):
+        """ `papers` is a list of (id, title, authors, abstract) tuples. """
+        paper_ids = np.array([paper[0] for paper in papers], dtype=np.int64)
+        postings = {}
+        for field_index, field in enumerate(MATCH_FIELDS, start=1):
+            # lowercase + str.split is exactly how the match search tokenizes
+            vectorizer = CountVectorizer(lowercase=True, tokenizer=str.split, token_pattern=None)
+            counts = vectorizer.fit_transform([paper[field_index] for paper in papers])
+            postings[field] = (vectorizer.vocabulary_, sparse.csr_matrix(counts.T, dtype=np.int32))
+        return cls(paper_ids, postings)
+
+    def save(self, filename=MATCH_INDEX_FILE):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as file:
+            pickle.dump({'paper_ids': self.paper_ids, 'postings': self.postings}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename=MATCH_INDEX_FILE):
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+        return cls(data['paper_ids'], data['postings'])
+
+    def patch(self, paper_id, title, authors, abstract):
+        """ Score `paper_id` with this text until the index is rebuilt, False if it is not in the index. """
+        row = find_rows(self.paper_ids, [paper_id])[0]
+        if row < 0:
+            return False
+        words = {field: Counter(text.lower().split()) for field, text in zip(MATCH_FIELDS, [title, authors, abstract])}
+        # a new dict, so searches running meanwhile see either the old or the new overrides
+        self.overrides = {**self.overrides, int(row): words}
+        return True
+
+    def postings_of(self, field, word):
+        """ Return (rows, counts) of the papers containing `word` in `field`. """
+        vocabulary, matrix = self.postings[field]
+        term = vocabulary.get(word)
+        if term is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        start, end = matrix.indptr[term], matrix.indptr[term + 1]
+        return matrix.indices[start:end], matrix.data[start:end]
+
+    def scores(self, query):
+        """ Raw match scores of all papers, only papers containing a query word are touched. """
+        scores = np.zeros(len(self.paper_ids), dtype=np.float64)
+        words = query.lower().split()
+        for word in words:
+            rows, _ = self.postings_of('title', word)
+            scores[rows] += TITLE_WEIGHT
+            rows, _ = self.postings_of('authors', word)
+            scores[rows] += AUTHORS_WEIGHT
+            rows, counts = self.postings_of('abstract', word)
+            scores[rows] += counts
+        for row, fields in self.overrides.items():
+            scores[row] = sum(TITLE_WEIGHT * (word in fields['title']) + AUTHORS_WEIGHT * (word in fields['authors'])
+                              + fields['abstract'][word] for word in words)
+        return scores
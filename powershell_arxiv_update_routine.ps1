@@ -1,6 +1,6 @@
 conda activate paper_helper
 Set-Location D:\Projects\PaperHelper  # Change this to the path of Paper helper.
-python ./arxiv_fetcher.py --num 50
+python ./arxiv_fetcher.py --harvest
 python ./compute_feature.py
 
 Write-Host -NoNewLine 'Press any key to continue...';
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+from sentence_transformers import SentenceTransformer
+from semantic_store import normalize_rows
+from result_cache import normalize_query
+
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L12-v2'
+# 'torch' is the default PyTorch model, 'onnx' runs it with ONNX Runtime (needs
+# sentence-transformers >= 3.2 and onnxruntime), 'int8' quantises its linear layers
+ENCODER_BACKENDS = ['torch', 'onnx', 'int8']
+DEFAULT_CACHE_SIZE = 1024
+
+
+def load_model(backend='torch'):
+    """ The MiniLM model for `backend`, raises if the backend can not be loaded. """
+    if backend == 'onnx':
+        return SentenceTransformer(MODEL_NAME, backend='onnx')
+    model = SentenceTransformer(MODEL_NAME)
+    if backend == 'int8':
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class QueryEncoder:
+    """ Encodes search queries, keeping the vectors of recent queries in an LRU cache.
+
+    MiniLM lower-cases its input and ignores repeated whitespace, so queries are
+    cached by their normalised text. The model can be loaded in a background
+    thread at startup; `ready` tells whether it is loaded, encode waits for it.
+    A backend that can not be loaded falls back to torch.
+    """
+
+    def __init__(self, backend='torch', cache_size=DEFAULT_CACHE_SIZE):
+        self.backend = backend if backend in ENCODER_BACKENDS else 'torch'
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.model = None
+        self.loader = None
+        self.loaded = threading.Event()
+        self.load_lock = threading.Lock()
+        # separate from load_lock, which is held while the model loads
+        self.loader_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.loaded.is_set()
+
+    def get_model(self):
+        """ The model, loaded now if it is not loaded or being loaded yet. """
+        if not self.loaded.is_set():
+            with self.load_lock:
+                if not self.loaded.is_set():
+                    start_time = time.time()
+                    try:
+                        self.model = load_model(self.backend)
+                    except Exception as e:
+                        if self.backend == 'torch':
+                            raise
+                        # `backend` tells which model is actually used
+                        print(f"Query encoder backend {self.backend} is not available, using torch: {e}")
+                        self.backend = 'torch'
+                        self.model = load_model('torch')
+                    self.loaded.set()
+                    print(f"Query encoder ({self.backend}) loaded in {time.time() - start_time} seconds.")
+        return self.model
+
+    def start_loading(self):
+        """ Load the model in a background thread, so the first search does not pay for it.
+
+        Only the first call starts a thread, it is cheap to call on every request.
+        """
+        if self.loader is None and not self.loaded.is_set():
+            with self.loader_lock:
+                if self.loader is None:
+                    self.loader = threading.Thread(target=self.get_model, name='query-encoder-loader', daemon=True)
+                    self.loader.start()
+        return self.loader
+
+    def encode(self, query):
+        """ Normalised float32 vector of `query`. """
+        return self.encode_many([query])[0]
+
+    def encode_many(self, queries):
+        """ Vectors of `queries`, the ones that are not cached are encoded in one batch. """
+        keys = [normalize_query(query) for query in queries]
+        vectors = {}
+        with self.cache_lock:
+            for key in keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    vectors[key] = self.cache[key]
+        missing = {key: query for key, query in zip(keys, queries) if key not in vectors}
+        if missing:
+            encoded = normalize_rows(self.get_model().encode(list(missing.values())))
+            with self.cache_lock:
+                for key, vector in zip(missing, encoded):
+                    vector.setflags(write=False)
+                    vectors[key] = self.cache[key] = vector
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return [vectors[key] for key in keys]
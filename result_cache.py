@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Ranked results kept in memory by every server process
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def normalize_query(query):
+    # all search features ignore case and repeated whitespace
+    return ' '.join(query.lower().split())
+
+
+def search_cache_key(query, filters, settings, index_version):
+    """ Key of a search result: the query, filters, search settings and feature version. """
+    key = {
+        'query': normalize_query(query),
+        'filters': {name: value for name, value in sorted(filters.items()) if value},
+        'search_feature': settings.get('search_feature'),
+        'feature_weights': settings.get('feature_weights'),
+        'fusion_method': settings.get('fusion_method', 'weighted'),
+        'rrf_k': settings.get('rrf_k', 60),
+        'index_version': index_version,
+    }
+    return 'search:' + hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def similar_cache_key(paper_id, settings, index_version):
+    """ Key of the similar papers of `paper_id`: the similar search settings and feature version. """
+    key = {
+        'paper_id': paper_id,
+        'similar_search_backend': settings.get('similar_search_backend', 'exact'),
+        'precompute_similar': settings.get('precompute_similar', False),
+        'index_version': index_version,
+    }
+    return 'similar:' + hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class SearchResultCache:
+    """ LRU cache of ranked (paper_ids, scores, total) search results.
+
+    Entries are compact arrays, the cache is bounded by their size in bytes.
+    With a `shared_cache` (a Flask-Caching backend such as FileSystemCache or
+    RedisCache) results are also shared between server processes. Keys contain
+    the feature version, so publishing new features invalidates all results.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, shared_cache=None, timeout=300):
+        self.max_bytes = max_bytes
+        self.shared_cache = shared_cache
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.size = 0
+        self.index_version = None
+        self.lock = threading.Lock()
+
+    def _check_version(self, index_version):
+        # results of older features can never be hit again
+        if index_version != self.index_version:
+            self.entries.clear()
+            self.size = 0
+            self.index_version = index_version
+
+    def get(self, key, index_version):
+        with self.lock:
+            self._check_version(index_version)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.shared_cache is not None:
+            entry = self.shared_cache.get(key)
+            if entry is not None:
+                self._store(key, entry, index_version)
+                return entry
+        return None
+
+    def set(self, key, paper_ids, scores, total, index_version):
+        entry = (np.asarray(paper_ids, dtype=np.int64), np.asarray(scores, dtype=np.float32), int(total))
+        self._store(key, entry, index_version)
+        if self.shared_cache is not None:
+            self.shared_cache.set(key, entry, timeout=self.timeout)
+        return entry
+
+    def _store(self, key, entry, index_version):
+        entry_size = entry[0].nbytes + entry[1].nbytes
+        if entry_size > self.max_bytes:
+            return
+        with self.lock:
+            self._check_version(index_version)
+            if key in self.entries:
+                old_entry = self.entries.pop(key)
+                self.size -= old_entry[0].nbytes + old_entry[1].nbytes
+            self.entries[key] = entry
+            self.size += entry_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[0].nbytes + evicted[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.shared_cache is not None:
+            self.shared_cache.clear()
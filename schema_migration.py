@@ -0,0 +1,76 @@
+""" Upgrade an existing papers.db to the current schema, in place.
+
+Adds the lookup indexes of `research_paper`, creates the `author`, `paper_author`,
+`category` and `paper_category` tables and fills them from the comma separated
+`authors` and `arxiv_category` columns. Running it again is safe, the links are
+rebuilt from scratch.
+"""
+import argparse
+import shutil
+import sys
+import time
+from flask import Flask
+from sqlalchemy import func, inspect, text
+from serve import ResearchPaper, Author, PaperAuthor, Category, paper_category, db, link_papers
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///papers.db'  # Update to match your configuration
+db.init_app(app)
+
+
+def find_duplicate_arxiv_ids():
+    return db.session.query(ResearchPaper.arxiv_id, func.count(ResearchPaper.id)).filter(
+        ResearchPaper.arxiv_id.isnot(None), ResearchPaper.arxiv_id != '').group_by(ResearchPaper.arxiv_id).having(func.count(ResearchPaper.id) > 1).all()
+
+
+def create_indexes():
+    existing_indexes = {index['name'] for index in inspect(db.engine).get_indexes(ResearchPaper.__tablename__)}
+    for index in ResearchPaper.__table__.indexes:
+        if index.name not in existing_indexes:
+            start_time = time.time()
+            index.create(db.engine)
+            print(f"Created index {index.name} in {time.time() - start_time} seconds.")
+
+
+def rebuild_links():
+    """ Fill the author and category tables from the papers, with bulk inserts. """
+    start_time = time.time()
+    papers = db.session.query(ResearchPaper.id, ResearchPaper.authors, ResearchPaper.arxiv_category).all()
+    db.session.execute(PaperAuthor.__table__.delete())
+    db.session.execute(paper_category.delete())
+    link_papers(db.session, papers)
+    db.session.commit()
+    print(f"Linked {len(papers)} papers to {Author.query.count()} authors and {Category.query.count()} categories "
+          f"in {time.time() - start_time} seconds.")
+
+
+def migrate(backup=True):
+    with app.app_context():
+        duplicates = find_duplicate_arxiv_ids()
+        if duplicates:
+            # the arxiv_id index is unique, these papers have to be merged first
+            for arxiv_id, count in duplicates:
+                print(f"Arxiv id {arxiv_id} is used by {count} papers.")
+            print("Merge or fix the papers above, then run the migration again.")
+            sys.exit(1)
+        if backup:
+            database = db.engine.url.database
+            shutil.copy2(database, database + '.bak')
+            print(f"Backed up {database} to {database}.bak")
+        # empty arxiv ids would collide in the unique index
+        db.session.query(ResearchPaper).filter(ResearchPaper.arxiv_id == '').update({ResearchPaper.arxiv_id: None})
+        db.session.commit()
+        db.create_all()
+        create_indexes()
+        rebuild_links()
+        # let SQLite's query planner know about the new indexes
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+    print("Schema migration complete.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upgrade papers.db to the current schema in place.')
+    parser.add_argument('--no_backup', action='store_true', help='do not copy papers.db to papers.db.bak first')
+    args = parser.parse_args()
+    migrate(backup=not args.no_backup)
@@ -0,0 +1,539 @@
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+import unicodedata
+from datetime import datetime
+import numpy as np
+from scipy import sparse
+from semantic_store import SEMANTIC_MATRIX_FILE, SEMANTIC_IDS_FILE, load_semantic_store, find_rows
+from match_index import MATCH_INDEX_FILE, MatchIndex
+from ann_index import ANN_INDEX_FILE, SemanticANNIndex
+from similar_table import SIMILAR_IDS_FILE, SIMILAR_NEIGHBOURS_FILE, SIMILAR_SCORES_FILE, load_similar_table
+
+# Feature artifacts written by compute_feature.py
+TFIDF_VECTORIZER_FILE = 'tfidf_vectorizer.pkl'
+TFIDF_FEATURE_FILE = 'tfidf_feature_vectors.npz'
+# paper id of every row in the TF-IDF matrix
+TFIDF_IDS_FILE = 'tfidf_paper_ids.npy'
+# compute_feature.py publishes the artifacts by writing this stamp after all of
+# them are written, so the server only picks up a complete set of features
+INDEX_VERSION_FILE = 'feature_version.json'
+FEATURE_FILES = [TFIDF_VECTORIZER_FILE, TFIDF_FEATURE_FILE, TFIDF_IDS_FILE, SEMANTIC_MATRIX_FILE, SEMANTIC_IDS_FILE,
+                 MATCH_INDEX_FILE, ANN_INDEX_FILE, SIMILAR_IDS_FILE, SIMILAR_NEIGHBOURS_FILE, SIMILAR_SCORES_FILE]
+# every published version is a directory of hard links to its artifacts, the last ones are kept
+FEATURE_VERSIONS_DIR = 'feature_versions'
+KEEP_FEATURE_VERSIONS = 3
+# edits patched into the published features, one JSON line per edit. Every server
+# process replays it, so all of them search the edited papers (see apply_patches)
+PATCH_LOG_FILE = 'feature_patches.jsonl'
+
+
+def write_index_version(filename=INDEX_VERSION_FILE, versions_dir=FEATURE_VERSIONS_DIR, keep=KEEP_FEATURE_VERSIONS,
+                        patch_log=PATCH_LOG_FILE):
+    """ Publish the current feature artifacts as a new version.
+
+    The artifacts are linked into a directory of the version, which the stamp
+    points to. The next run replaces the artifacts with new files, so the
+    published set is not affected while the server loads it.
+    """
+    version = f"{time.time():.6f}"
+    directory = os.path.join(versions_dir, version)
+    os.makedirs(directory)
+    for name in FEATURE_FILES:
+        if os.path.exists(name):
+            try:
+                os.link(name, os.path.join(directory, name))
+            except OSError:
+                # file systems without hard links
+                shutil.copy2(name, os.path.join(directory, name))
+    stamp = {'version': version, 'directory': directory}
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(stamp, file)
+    os.replace(tmp_filename, filename)
+    # the patches were made to older versions, which no process loads any more
+    if os.path.exists(patch_log):
+        os.remove(patch_log)
+    versions = sorted(os.listdir(versions_dir), key=float)
+    for old_version in versions[:-keep]:
+        shutil.rmtree(os.path.join(versions_dir, old_version), ignore_errors=True)
+
+
+def read_index_version(filename=INDEX_VERSION_FILE):
+    """ Return (version, directory) of the published features.
+
+    Features published by older versions have no directory, they are read from
+    the working directory and versioned by the modification time of the files.
+    """
+    try:
+        with open(filename, 'r') as file:
+            version = str(os.fstat(file.fileno()).st_mtime_ns)
+            directory = json.load(file).get('directory', '')
+        return version, directory if os.path.isdir(directory) else ''
+    except (OSError, ValueError):
+        pass
+    mtimes = [os.stat(f).st_mtime_ns for f in FEATURE_FILES if os.path.exists(f)]
+    if not mtimes:
+        return None, ''
+    return str(max(mtimes)), ''
+
+
+class SearchIndex:
+    """ Everything search needs, loaded once and shared by all requests.
+
+    Rows of the index follow `paper_ids` (sorted by paper id). A new index is
+    built next to the old one and swapped in when the features change.
+    """
+
+    def __init__(self, version, paper_ids, publication_names, filter_rows=None, match_index=None,
+                 vectorizer=None, tfidf_ids=None, tfidf_matrix=None, semantic_ids=None, semantic_matrix=None,
+                 semantic_ann=None, similar_table=None):
+        self.version = version
+        self.paper_ids = paper_ids
+        self.publication_names = publication_names
+        # {filter: {value: sorted index rows}}, see FILTER_FIELDS
+        self.filter_rows = filter_rows or {}
+        self.match_index = match_index
+        # index row of every row of the match index
+        self.match_rows = find_rows(paper_ids, match_index.paper_ids) if match_index is not None else None
+        self.vectorizer = vectorizer
+        self.tfidf_ids = tfidf_ids
+        self.tfidf_matrix = tfidf_matrix
+        self.semantic_ids = semantic_ids
+        self.semantic_matrix = semantic_matrix
+        self.semantic_ann = semantic_ann
+        self.similar_table = similar_table
+        # index row of every feature row, -1 for papers deleted since the features were computed
+        self.tfidf_rows = find_rows(paper_ids, tfidf_ids) if tfidf_ids is not None else None
+        self.semantic_rows = find_rows(paper_ids, semantic_ids) if semantic_ids is not None else None
+        # and the other way round, feature row of every index row
+        self.tfidf_of_row = invert_rows(len(paper_ids), self.tfidf_rows)
+        self.semantic_of_row = invert_rows(len(paper_ids), self.semantic_rows)
+        self.match_of_row = invert_rows(len(paper_ids), self.match_rows)
+        # `version` with the patches applied from the patch log, the same in every process, see apply_patches
+        self.cache_version = version
+        self.patch_log_offset = 0
+        # papers whose precomputed similar papers are out of date
+        self.stale_similar = set()
+        self.patch_lock = threading.Lock()
+        self.patch_log_lock = threading.Lock()
+
+    def __repr__(self):
+        # used in cache keys, so it must identify the published features and patches
+        return f"SearchIndex(version={self.cache_version}, papers={len(self.paper_ids)})"
+
+    def __len__(self):
+        return len(self.paper_ids)
+
+    def rows_of(self, paper_ids):
+        """ Index rows of `paper_ids`, -1 for papers that are not in the index. """
+        return find_rows(self.paper_ids, paper_ids)
+
+    def candidate_rows(self, filters):
+        """ Sorted index rows passing all `filters`, None when no filter is set. """
+        rows = None
+        for name, value in filters.items():
+            if not value:
+                continue
+            value_rows = self.filter_rows.get(name, {}).get(normalize_filter_value(name, value), EMPTY_ROWS)
+            rows = value_rows if rows is None else np.intersect1d(rows, value_rows, assume_unique=True)
+        return rows
+
+    def tfidf_similarities(self, query_vector, rows=None):
+        """ Cosine similarities of `rows` (all rows if None), 0 for papers without a vector. """
+        feature_rows = self.tfidf_of_row if rows is None else self.tfidf_of_row[rows]
+        found = feature_rows >= 0
+        similarities = np.zeros(len(feature_rows), dtype=np.float64)
+        # rows and query are normalised, so the dot product is the cosine similarity
+        similarities[found] = (self.tfidf_matrix[feature_rows[found]] @ query_vector.T).toarray().ravel()
+        return similarities
+
+    def semantic_similarities(self, query_vector, rows=None):
+        """ Cosine similarities of `rows` (all rows if None), 0 for papers without a vector. """
+        feature_rows = self.semantic_of_row if rows is None else self.semantic_of_row[rows]
+        found = feature_rows >= 0
+        similarities = np.zeros(len(feature_rows), dtype=np.float64)
+        if rows is None and found.all() and len(feature_rows) == len(self.semantic_ids):
+            # stored rows are normalised, so cosine similarity is a single matvec
+            similarities[:] = self.semantic_matrix @ query_vector
+        else:
+            similarities[found] = self.semantic_matrix[feature_rows[found]] @ query_vector
+        return similarities
+
+    def match_scores(self, query, rows=None):
+        """ Raw match scores of `rows` (all rows if None), 0 for papers missing from the match index. """
+        raw_scores = self.match_index.scores(query)
+        feature_rows = self.match_of_row if rows is None else self.match_of_row[rows]
+        found = feature_rows >= 0
+        scores = np.zeros(len(feature_rows), dtype=np.float64)
+        scores[found] = raw_scores[feature_rows[found]]
+        return scores
+
+    def precomputed_similar(self, paper_id, top_n):
+        """ (paper_ids, scores) from the similar papers table, None if it can not answer. """
+        if self.similar_table is None or paper_id in self.stale_similar:
+            return None
+        table_ids, neighbours, scores = self.similar_table
+        row = find_rows(table_ids, [paper_id])[0]
+        if row < 0 or neighbours.shape[1] < top_n:
+            return None
+        row_neighbours = np.asarray(neighbours[row, :top_n], dtype=np.int64)
+        if self.stale_similar and np.isin(row_neighbours, list(self.stale_similar)).any():
+            return None
+        valid = row_neighbours >= 0
+        return row_neighbours[valid], np.asarray(scores[row, :top_n], dtype=np.float32)[valid]
+
+    def patch_paper(self, paper_id, tfidf_vector=None, semantic_vector=None, match_texts=None, old_paper=None, paper=None):
+        """ Apply an edit of a paper to the index until the next features are published.
+
+        The TF-IDF and semantic vectors are replaced, the match index scores the
+        (title, authors, abstract) `match_texts`, and the filters move the paper
+        from the values of `old_paper` to those of `paper`, (id, publication_name,
+        publication_date, arxiv_upload_date, arxiv_category, authors) tuples.
+        Words outside the TF-IDF vocabulary are only found by the match search.
+        Papers without stored features are left to compute_feature.py.
+        Precomputed similar papers involving the paper are no longer used.
+        Edits are applied by apply_patches, which also updates `cache_version`.
+        """
+        with self.patch_lock:
+            if match_texts is not None and self.match_index is not None:
+                self.match_index.patch(paper_id, *match_texts)
+            if old_paper is not None and paper is not None:
+                self.patch_filter_rows(old_paper, paper)
+            if tfidf_vector is not None and self.tfidf_matrix is not None:
+                row = find_rows(self.tfidf_ids, [paper_id])[0]
+                if row >= 0:
+                    # a new matrix, requests that hold the old one are not affected
+                    self.tfidf_matrix = replace_csr_row(self.tfidf_matrix, row, tfidf_vector)
+            if semantic_vector is not None:
+                row = self.semantic_row(paper_id)
+                if row is not None:
+                    if not self.semantic_matrix.flags.writeable:
+                        self.semantic_matrix = np.array(self.semantic_matrix)
+                    self.semantic_matrix[row] = semantic_vector
+                    if self.semantic_ann is not None:
+                        # replaces the vector of the paper
+                        self.semantic_ann.add([paper_id], [semantic_vector])
+                self.stale_similar.add(paper_id)
+
+    def apply_patches(self, filename=PATCH_LOG_FILE):
+        """ Apply the edits other processes (or this one) appended to the patch log since the last call.
+
+        Edits of other feature versions are skipped. The log offset becomes part
+        of `cache_version`, so every process that applied the same edits caches
+        its results under the same keys, and results of the unpatched index are
+        not used any more.
+        """
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
+        if size == self.patch_log_offset:
+            return
+        with self.patch_log_lock:
+            if size < self.patch_log_offset:
+                # a new log was started, it can only hold edits of a newer version
+                self.patch_log_offset = 0
+            try:
+                with open(filename, 'rb') as file:
+                    file.seek(self.patch_log_offset)
+                    data = file.read()
+            except OSError:
+                data = b''
+            # a line being written is read by the next call
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                patch = json.loads(line)
+                if patch['version'] == self.version:
+                    self.apply_patch(patch)
+            self.patch_log_offset += len(data)
+            if self.patch_log_offset:
+                self.cache_version = f"{self.version}+{self.patch_log_offset}"
+
+    def apply_patch(self, patch):
+        """ patch_paper with an edit of the patch log, see append_patch. """
+        tfidf_vector = None
+        if patch.get('tfidf_text') is not None and self.vectorizer is not None:
+            tfidf_vector = self.vectorizer.transform([patch['tfidf_text']])
+        semantic_vector = None
+        if patch.get('semantic_vector') is not None:
+            semantic_vector = np.array(patch['semantic_vector'], dtype=np.float32)
+        self.patch_paper(patch['paper_id'], tfidf_vector, semantic_vector, match_texts=patch.get('match_texts'),
+                         old_paper=index_row_from_json(patch['old_paper']), paper=index_row_from_json(patch['paper']))
+
+    def patch_filter_rows(self, old_paper, paper):
+        row = self.rows_of([paper[0]])[0]
+        if row < 0:
+            return
+        old_values, new_values = paper_filter_values(old_paper), paper_filter_values(paper)
+        for name in FILTER_FIELDS:
+            value_rows = self.filter_rows.setdefault(name, {})
+            for value in old_values[name] - new_values[name]:
+                if value in value_rows:
+                    value_rows[value] = value_rows[value][value_rows[value] != row]
+            for value in new_values[name] - old_values[name]:
+                rows = value_rows.get(value, EMPTY_ROWS)
+                position = np.searchsorted(rows, row)
+                # an index loaded after the edit already has it
+                if position == len(rows) or rows[position] != row:
+                    value_rows[value] = np.insert(rows, position, row).astype(np.int32)
+        self.publication_names[row] = paper[1]
+
+    def semantic_row(self, paper_id):
+        """ Row of `paper_id` in the semantic matrix, None if it has no vector. """
+        if self.semantic_ids is None:
+            return None
+        row = find_rows(self.semantic_ids, [paper_id])[0]
+        return None if row < 0 else int(row)
+
+    @classmethod
+    def load(cls, papers, version=None, directory=''):
+        """ Build an index from the feature files in `directory` and `papers`.
+
+        `papers` is a list of (id, publication_name, publication_date,
+        arxiv_upload_date, arxiv_category, authors) tuples sorted by id.
+        """
+        start_time = time.time()
+        vectorizer_file, feature_file, ids_file, match_file, ann_file = [
+            os.path.join(directory, name) for name in [TFIDF_VECTORIZER_FILE, TFIDF_FEATURE_FILE, TFIDF_IDS_FILE,
+                                                       MATCH_INDEX_FILE, ANN_INDEX_FILE]]
+        paper_ids = np.array([paper[0] for paper in papers], dtype=np.int64)
+        publication_names = np.array([paper[1] for paper in papers], dtype=object)
+        filter_rows = build_filter_rows(papers)
+
+        vectorizer = None
+        if os.path.exists(vectorizer_file):
+            with open(vectorizer_file, 'rb') as file:
+                vectorizer = pickle.load(file)
+
+        tfidf_ids, tfidf_matrix = None, None
+        if os.path.exists(feature_file):
+            tfidf_matrix = sparse.load_npz(feature_file).tocsr()
+            if os.path.exists(ids_file):
+                tfidf_ids = np.load(ids_file)
+            elif tfidf_matrix.shape[0] == len(paper_ids):
+                # features computed by older versions have one row per paper, in id order
+                tfidf_ids = paper_ids
+            else:
+                print(f"'{TFIDF_IDS_FILE}' not found and the TF-IDF matrix does not match the papers, TF-IDF search is disabled.")
+                tfidf_matrix = None
+
+        # rows are L2-normalised, memory-mapped where the platform allows it
+        semantic_ids, semantic_matrix = load_semantic_store(directory=directory)
+
+        match_index = MatchIndex.load(match_file)
+        # optional HNSW index for similar papers, needs hnswlib
+        semantic_ann = SemanticANNIndex.load(semantic_matrix.shape[1], ann_file) if semantic_matrix is not None else None
+        # optional precomputed similar papers
+        similar_table = load_similar_table(directory=directory)
+
+        index = cls(version, paper_ids, publication_names, filter_rows, match_index,
+                    vectorizer, tfidf_ids, tfidf_matrix, semantic_ids, semantic_matrix, semantic_ann, similar_table)
+        print(f"Search index loaded with {len(index)} papers in {time.time() - start_time} seconds.")
+        return index
+
+
+# Search filters, papers are selected by these before any scoring
+FILTER_FIELDS = ['publication_name', 'year', 'category', 'author']
+EMPTY_ROWS = np.zeros(0, dtype=np.int32)
+
+
+def normalize_author_name(name):
+    # same normalisation as the fetchers, plus case and spacing
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join([c for c in name if not unicodedata.combining(c)])
+    return ' '.join(name.lower().split())
+
+
+def normalize_filter_value(name, value):
+    if name == 'author':
+        return normalize_author_name(value)
+    if name == 'year':
+        return str(value).strip()
+    return value.strip()
+
+
+def index_row_to_json(paper):
+    return [value.isoformat() if isinstance(value, datetime) else value for value in paper]
+
+
+def index_row_from_json(values):
+    # the publication and upload dates are stored as ISO strings
+    return tuple(datetime.fromisoformat(value) if i in (2, 3) and value else value for i, value in enumerate(values))
+
+
+def append_patch(version, paper_id, old_paper, paper, tfidf_text=None, semantic_vector=None, match_texts=None,
+                 filename=PATCH_LOG_FILE):
+    """ Log an edit of a paper for SearchIndex.apply_patches of every server process.
+
+    `old_paper` and `paper` are index rows as in SearchIndex.load. The text and
+    vectors are only given when the text of the paper changed.
+    """
+    patch = {
+        'version': version,
+        'paper_id': int(paper_id),
+        'old_paper': index_row_to_json(old_paper),
+        'paper': index_row_to_json(paper),
+        'tfidf_text': tfidf_text,
+        'semantic_vector': None if semantic_vector is None else [float(value) for value in semantic_vector],
+        'match_texts': None if match_texts is None else list(match_texts),
+    }
+    # one append of a whole line, readers skip a line until it is complete
+    descriptor = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(descriptor, (json.dumps(patch) + '\n').encode())
+    finally:
+        os.close(descriptor)
+
+
+def paper_filter_values(paper):
+    """ {filter: set of values} of a (id, publication_name, publication_date, arxiv_upload_date,
+    arxiv_category, authors) tuple. """
+    _, publication_name, publication_date, arxiv_upload_date, arxiv_category, authors = paper
+    return {
+        'publication_name': {publication_name} if publication_name else set(),
+        # a paper is found by the year of its publication and of its arXiv upload
+        'year': {str(date.year) for date in [publication_date, arxiv_upload_date] if date},
+        'category': {category.strip() for category in (arxiv_category or '').split(',') if category.strip()},
+        'author': {normalize_author_name(author) for author in (authors or '').split(',')} - {''},
+    }
+
+
+def build_filter_rows(papers):
+    """ {filter: {value: sorted index rows}} for the papers of the index. """
+    filter_values = {name: {} for name in FILTER_FIELDS}
+    for row, paper in enumerate(papers):
+        for name, values in paper_filter_values(paper).items():
+            for value in values:
+                filter_values[name].setdefault(value, []).append(row)
+    return {name: {value: np.array(rows, dtype=np.int32) for value, rows in values.items()}
+            for name, values in filter_values.items()}
+
+
+def replace_csr_row(matrix, row, vector):
+    """ Copy of the CSR `matrix` with `row` replaced by the 1 x n sparse `vector`. """
+    vector = sparse.csr_matrix(vector, dtype=matrix.dtype)
+    vector.sort_indices()
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    indices = np.concatenate([matrix.indices[:start], vector.indices, matrix.indices[end:]])
+    data = np.concatenate([matrix.data[:start], vector.data, matrix.data[end:]])
+    indptr = matrix.indptr.copy()
+    indptr[row + 1:] += vector.nnz - (end - start)
+    return sparse.csr_matrix((data, indices, indptr), shape=matrix.shape)
+
+
+def invert_rows(n_rows, rows):
+    """ Position in `rows` of each of the `n_rows` index rows, -1 if it is not there. """
+    inverted = np.full(n_rows, -1, dtype=np.int64)
+    if rows is not None:
+        valid = rows >= 0
+        inverted[rows[valid]] = np.flatnonzero(valid)
+    return inverted
+
+
+def top_k(scores, k):
+    """ Positions of the `k` highest scores, highest first.
+
+    Only the selected scores are sorted, so the cost grows with `k` rather than
+    with the number of papers.
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        # keep every score tied with the k-th one, so ties are broken by position like a stable sort
+        selected = np.flatnonzero(scores >= threshold)
+    else:
+        selected = np.arange(len(scores))
+    return selected[np.lexsort((selected, -scores[selected]))][:k]
+
+
+# Search features fused in 'combination' mode, with their keys in the feature_weights setting
+SEARCH_FEATURES = ['tf-idf', 'semantic', 'match']
+FEATURE_WEIGHT_KEYS = {'tf-idf': 'tfidf', 'semantic': 'semantic', 'match': 'match'}
+
+
+# Feature scores are (scores, present, hits) tuples over the candidate rows:
+# `present` marks papers that take part in the ranking and `hits` the papers
+# that actually match the query.
+
+def similarity_feature_scores(similarities):
+    # papers with a positive similarity, normalised by the best one
+    hits = similarities > 0
+    scores = np.zeros_like(similarities)
+    if hits.any():
+        scores[hits] = similarities[hits] / similarities[hits].max()
+    return scores, hits, hits
+
+
+def match_feature_scores(raw_scores):
+    # every paper is ranked, centred on the average and normalised by the best score
+    max_score = raw_scores.max() if len(raw_scores) else 0
+    scores = (raw_scores - raw_scores.mean()) / (max_score or 1) if len(raw_scores) else raw_scores
+    return scores, np.ones(len(raw_scores), dtype=bool), raw_scores > 0
+
+
+def weighted_fusion(feature_scores, weights):
+    """ Weighted sum of the feature scores, normalised by the best combined score. """
+    combined = None
+    present = None
+    for feature, (scores, feature_present, _) in feature_scores.items():
+        weighted = np.where(feature_present, scores, 0) * weights[FEATURE_WEIGHT_KEYS[feature]]
+        combined = weighted if combined is None else combined + weighted
+        present = feature_present if present is None else present | feature_present
+    max_score = combined[present].max() if present.any() else 0
+    if max_score:
+        combined = combined / max_score
+    return combined, present
+
+
+def reciprocal_rank_fusion(feature_scores, weights, k=60):
+    """ Sum of weight / (k + rank) over the features a paper matches.
+
+    Only the ranks are used, so features with very different score
+    distributions cannot dominate each other.
+    """
+    fused = None
+    present = None
+    for feature, (scores, _, hits) in feature_scores.items():
+        if fused is None:
+            fused = np.zeros(len(scores), dtype=np.float64)
+            present = np.zeros(len(scores), dtype=bool)
+        rows = np.flatnonzero(hits)
+        ranked_rows = rows[np.lexsort((rows, -scores[rows]))]
+        fused[ranked_rows] += weights[FEATURE_WEIGHT_KEYS[feature]] / (k + np.arange(1, len(ranked_rows) + 1))
+        present |= hits
+    # normalised like the other modes, so the best paper scores 1
+    if present.any() and fused.max() > 0:
+        fused = fused / fused.max()
+    return fused, present
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index(load_papers):
+    """ Return the current search index, reloading it if new features were published,
+    with the edits of the patch log applied.
+
+    `load_papers` is called without arguments to read the paper table when the
+    index is (re)built.
+    """
+    global _search_index
+    version, directory = read_index_version()
+    index = _search_index
+    if index is None or index.version != version:
+        with _search_index_lock:
+            # another request may have reloaded the index while we were waiting
+            if _search_index is None or _search_index.version != version:
+                # build the new index completely before swapping it in, requests
+                # holding the old one keep using it
+                _search_index = SearchIndex.load(load_papers(), version, directory)
+            index = _search_index
+    # edits made by any server process since the features were published
+    index.apply_patches()
+    return index
@@ -0,0 +1,91 @@
+import argparse
+import os
+import time
+import numpy as np
+
+# Semantic vectors are stored as an (N, dim) float32 matrix of L2-normalised rows
+# and the matching paper ids (int64, sorted), so the files can be memory-mapped
+# and cosine similarity is a single dot product.
+SEMANTIC_MATRIX_FILE = 'semantic_vectors.npy'
+SEMANTIC_IDS_FILE = 'semantic_paper_ids.npy'
+# Format used before 0.0.5: a pickled {str(paper_id): vector} dict
+LEGACY_SEMANTIC_VECTORS_FILE = 'semantic_vectors.npz'
+# Windows does not allow replacing a file that another process has mapped, so
+# the server reads the matrix into memory there. Mappings are copy-on-write, so
+# the server can patch the rows of edited papers in memory.
+DEFAULT_MMAP_MODE = None if os.name == 'nt' else 'c'
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def save_array(filename, array):
+    # write to a temporary file first so readers never see a half-written file
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_filename, filename)
+
+
+def save_semantic_store(paper_ids, vectors):
+    paper_ids = np.asarray(paper_ids, dtype=np.int64)
+    order = np.argsort(paper_ids, kind='stable')
+    matrix = np.ascontiguousarray(normalize_rows(vectors)[order])
+    save_array(SEMANTIC_MATRIX_FILE, matrix)
+    save_array(SEMANTIC_IDS_FILE, paper_ids[order])
+
+
+def load_semantic_store(mmap_mode=DEFAULT_MMAP_MODE, directory=''):
+    """ Return (paper_ids, matrix), or (None, None) if no vectors are stored. """
+    matrix_file, ids_file = os.path.join(directory, SEMANTIC_MATRIX_FILE), os.path.join(directory, SEMANTIC_IDS_FILE)
+    if not (os.path.exists(matrix_file) and os.path.exists(ids_file)):
+        return None, None
+    paper_ids = np.load(ids_file)
+    matrix = np.load(matrix_file, mmap_mode=mmap_mode)
+    return paper_ids, matrix
+
+
+def patch_semantic_store(paper_id, vector):
+    """ Overwrite the stored vector of `paper_id` in place, False if it has no stored vector.
+
+    The published feature version links the same file, so it gets the new row too.
+    """
+    if not (os.path.exists(SEMANTIC_MATRIX_FILE) and os.path.exists(SEMANTIC_IDS_FILE)):
+        return False
+    row = find_rows(np.load(SEMANTIC_IDS_FILE, mmap_mode='r'), [paper_id])[0]
+    if row < 0:
+        return False
+    matrix = np.load(SEMANTIC_MATRIX_FILE, mmap_mode='r+')
+    matrix[row] = normalize_rows(vector)
+    matrix.flush()
+    return True
+
+
+def find_rows(sorted_ids, paper_ids):
+    """ Rows of `paper_ids` in `sorted_ids`, -1 for ids that are not present. """
+    paper_ids = np.asarray(paper_ids, dtype=np.int64)
+    rows = np.searchsorted(sorted_ids, paper_ids)
+    rows[rows >= len(sorted_ids)] = 0
+    found = sorted_ids[rows] == paper_ids if len(sorted_ids) else np.zeros(len(paper_ids), dtype=bool)
+    return np.where(found, rows, -1)
+
+
+def convert_legacy_semantic_vectors(filename=LEGACY_SEMANTIC_VECTORS_FILE):
+    """ Convert the pickled dict in semantic_vectors.npz to the new store. """
+    start_time = time.time()
+    semantic_vectors = np.load(filename, allow_pickle=True)['vectors'].item()
+    paper_ids = np.array([int(pid) for pid in semantic_vectors.keys()], dtype=np.int64)
+    vectors = np.array([semantic_vectors[pid] for pid in semantic_vectors.keys()], dtype=np.float32)
+    save_semantic_store(paper_ids, vectors)
+    print(f"Converted {len(paper_ids)} semantic vectors from '{filename}' to '{SEMANTIC_MATRIX_FILE}' in {time.time() - start_time} seconds.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert semantic vectors from the old semantic_vectors.npz format.')
+    parser.add_argument('--legacy_path', type=str, default=LEGACY_SEMANTIC_VECTORS_FILE, help='Path to the old semantic_vectors.npz')
+    args = parser.parse_args()
+    convert_legacy_semantic_vectors(args.legacy_path)
@@ -1,29 +1,56 @@
 import json
-from flask import Flask, request, jsonify, render_template, flash, get_flashed_messages, redirect, url_for
+from flask import (Flask, request, jsonify, render_template, flash, get_flashed_messages, redirect, url_for,
+                   Response, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, func, tuple_
 from sklearn.feature_extraction.text import TfidfVectorizer
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-import pickle
 import os
-from scipy import sparse
 from datetime import datetime
-from sentence_transformers import SentenceTransformer
 import time
 from flask_caching import Cache
+from search_index import (get_search_index, top_k, similarity_feature_scores, match_feature_scores,
+                          weighted_fusion, reciprocal_rank_fusion, normalize_author_name, SEARCH_FEATURES, FILTER_FIELDS,
+                          append_patch)
+from result_cache import SearchResultCache, search_cache_key, similar_cache_key
+from query_encoder import QueryEncoder
+from semantic_store import normalize_rows, patch_semantic_store
+from job_runner import JobRunner
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///papers.db'
 app.config['SECRET_KEY'] = 'your_secret_key'
 db = SQLAlchemy(app)
-# cache
-cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+# cache, set CACHE_TYPE=FileSystemCache (with CACHE_DIR) or RedisCache (with CACHE_REDIS_URL)
+# to share search results between server processes, e.g. gunicorn workers
+cache = Cache(config={
+    'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'SimpleCache'),
+    'CACHE_DIR': os.environ.get('CACHE_DIR', 'search_cache'),
+    'CACHE_REDIS_URL': os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+})
 cache.init_app(app)
 # Set a timeout for cache, e.g., 5 minutes
 CACHE_TIMEOUT = 300
-sentence_transformer_model = None
+# Ranked search results, every process keeps the recent ones in memory
+result_cache = SearchResultCache(
+    shared_cache=None if os.environ.get('CACHE_TYPE', 'SimpleCache') in ['SimpleCache', 'NullCache'] else cache,
+    timeout=CACHE_TIMEOUT)
+# Search results are cached at least this deep, so the next pages are hits too
+MIN_CACHED_RESULTS = 100
+# Query vectors of semantic search, QUERY_ENCODER_BACKEND=onnx or int8 selects a faster CPU encoder
+query_encoder = QueryEncoder(backend=os.environ.get('QUERY_ENCODER_BACKEND', 'torch'))
+# Feature recomputation and fetches started from the web pages, run one at a time in the background
+job_runner = JobRunner()
 
 class ResearchPaper(db.Model):
+    # papers are looked up by arxiv_id (arXiv fetcher) and by (title, authors) (dblp
+    # fetcher, bib import, corrector), and browsed by upload date
+    __table_args__ = (
+        db.Index('ix_research_paper_arxiv_id', 'arxiv_id', unique=True),
+        db.Index('ix_research_paper_title_authors', 'title', 'authors'),
+        db.Index('ix_research_paper_arxiv_upload_date', 'arxiv_upload_date'),
+        db.Index('ix_research_paper_publication_name', 'publication_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), nullable=False)
     authors = db.Column(db.String(500), nullable=False)
@@ -35,7 +62,9 @@ class ResearchPaper(db.Model):
     publication_name = db.Column(db.String(250), nullable=True)
     publication_date = db.Column(db.DateTime, nullable=True)
     publication_url = db.Column(db.String(500), nullable=True)
-    
+    # normalised copies of `authors` and `arxiv_category`, maintained by sync_paper_links
+    author_links = db.relationship('PaperAuthor', order_by='PaperAuthor.position', cascade='all, delete-orphan')
+    categories = db.relationship('Category', secondary='paper_category')
 
     def to_dict(self):
         return {
@@ -52,13 +81,122 @@ class ResearchPaper(db.Model):
             'publication_url': self.publication_url
         }
 
+
+class Author(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(250), nullable=False)
+    # authors are the same person when their names match ignoring case, accents and spacing
+    normalized_name = db.Column(db.String(250), nullable=False, unique=True)
+
+
+class PaperAuthor(db.Model):
+    __tablename__ = 'paper_author'
+    paper_id = db.Column(db.Integer, db.ForeignKey('research_paper.id'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False, index=True)
+    author = db.relationship('Author')
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+
+
+paper_category = db.Table(
+    'paper_category',
+    db.Column('paper_id', db.Integer, db.ForeignKey('research_paper.id'), primary_key=True),
+    db.Column('category_id', db.Integer, db.ForeignKey('category.id'), primary_key=True, index=True),
+)
+
+
+def split_names(value):
+    """ Names of a comma separated `authors` or `arxiv_category` value. """
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def get_or_create_rows(session, model, key_column, values):
+    """ {key: row} of `model` for the {key: column values} in `values`, missing rows are added. """
+    rows = {}
+    keys = list(values)
+    for start in range(0, len(keys), 500):
+        for row in session.query(model).filter(key_column.in_(keys[start:start + 500])):
+            rows[getattr(row, key_column.key)] = row
+    for key, columns in values.items():
+        if key not in rows:
+            rows[key] = model(**columns)
+            session.add(rows[key])
+    return rows
+
+
+@event.listens_for(db.session, 'before_flush')
+def sync_paper_links(session, flush_context, instances):
+    """ Rebuild the author and category links of papers whose authors or categories changed. """
+    papers = [paper for paper in session.new if isinstance(paper, ResearchPaper)]
+    for paper in session.dirty:
+        if isinstance(paper, ResearchPaper):
+            state = inspect(paper)
+            if state.attrs.authors.history.has_changes() or state.attrs.arxiv_category.history.has_changes():
+                papers.append(paper)
+    if not papers:
+        return
+    with session.no_autoflush:
+        author_values, category_values = {}, {}
+        for paper in papers:
+            for name in split_names(paper.authors):
+                author_values.setdefault(normalize_author_name(name), {'name': name, 'normalized_name': normalize_author_name(name)})
+            for name in split_names(paper.arxiv_category):
+                category_values.setdefault(name, {'name': name})
+        authors = get_or_create_rows(session, Author, Author.normalized_name, author_values)
+        categories = get_or_create_rows(session, Category, Category.name, category_values)
+        for paper in papers:
+            paper.author_links = [PaperAuthor(position=position, author=authors[normalize_author_name(name)])
+                                  for position, name in enumerate(split_names(paper.authors))]
+            paper.categories = [categories[name] for name in dict.fromkeys(split_names(paper.arxiv_category))]
+
+
+def link_papers(session, papers, chunk_size=500):
+    """ Replace the author and category links of papers written with bulk statements.
+
+    `papers` is a list of (id, authors, arxiv_category) tuples. Bulk inserts and
+    updates bypass the ORM, so sync_paper_links does not see them.
+    """
+    author_values, category_values = {}, {}
+    for _, authors, categories in papers:
+        for name in split_names(authors):
+            author_values.setdefault(normalize_author_name(name), {'name': name, 'normalized_name': normalize_author_name(name)})
+        for name in split_names(categories):
+            category_values.setdefault(name, {'name': name})
+    author_ids, category_ids = {}, {}
+    for model, key_column, values, ids in [(Author, Author.normalized_name, author_values, author_ids),
+                                           (Category, Category.name, category_values, category_ids)]:
+        keys = list(values)
+        for start in range(0, len(keys), chunk_size):
+            ids.update(session.query(key_column, model.id).filter(key_column.in_(keys[start:start + chunk_size])).all())
+        missing = [columns for key, columns in values.items() if key not in ids]
+        if missing:
+            session.execute(db.insert(model), missing)
+            for start in range(0, len(missing), chunk_size):
+                chunk = [columns[key_column.key] for columns in missing[start:start + chunk_size]]
+                ids.update(session.query(key_column, model.id).filter(key_column.in_(chunk)).all())
+
+    paper_ids = [paper[0] for paper in papers]
+    for start in range(0, len(paper_ids), chunk_size):
+        chunk = paper_ids[start:start + chunk_size]
+        session.execute(db.delete(PaperAuthor).where(PaperAuthor.paper_id.in_(chunk)))
+        session.execute(db.delete(paper_category).where(paper_category.c.paper_id.in_(chunk)))
+    author_links = [{'paper_id': paper_id, 'position': position, 'author_id': author_ids[normalize_author_name(name)]}
+                    for paper_id, authors, _ in papers for position, name in enumerate(split_names(authors))]
+    category_links = [{'paper_id': paper_id, 'category_id': category_ids[name]}
+                      for paper_id, _, categories in papers for name in dict.fromkeys(split_names(categories))]
+    if author_links:
+        session.execute(db.insert(PaperAuthor), author_links)
+    if category_links:
+        session.execute(db.insert(paper_category), category_links)
+
 # db.create_all()
     
 def get_sentence_transformer_model():
-    global sentence_transformer_model
-    if sentence_transformer_model is None:
-        sentence_transformer_model = SentenceTransformer('sentence-transformers/all-MiniLM-L12-v2')
-    return sentence_transformer_model
+    return query_encoder.get_model()
 
 def read_settings():
     with open('settings.json', 'r') as file:
@@ -66,186 +204,283 @@ def read_settings():
 
 
 
-# For TF-IDF vectors
-def load_vectorizer():
-    try:
-        with open('tfidf_vectorizer.pkl', 'rb') as file:
-            return pickle.load(file)
-    except FileNotFoundError:
-        flash("Vectorizer file not found. Please run 'compute_feature.py' to generate search vectors.", "error")
-        return None
+# Search index, loaded once and reloaded when compute_feature.py publishes new features
+def load_index_papers():
+    return db.session.query(ResearchPaper.id, ResearchPaper.publication_name, ResearchPaper.publication_date,
+                            ResearchPaper.arxiv_upload_date, ResearchPaper.arxiv_category,
+                            ResearchPaper.authors).order_by(ResearchPaper.id).all()
 
-# load tfidf vectors
-def load_tfidf_feature_vectors():
-    if os.path.exists('tfidf_feature_vectors.npz'):
-        return sparse.load_npz('tfidf_feature_vectors.npz')
-    return None
+def load_search_index():
+    index = get_search_index(load_index_papers)
+    if index.vectorizer is None or index.tfidf_matrix is None or index.semantic_matrix is None or index.match_index is None:
+        flash("Feature files not found. Please run 'compute_feature.py' to generate search vectors.", "error")
+        return None
+    return index
 
-def load_semantic_vectors():
-    if os.path.exists('semantic_vectors.npz'):
-        return np.load('semantic_vectors.npz', allow_pickle=True)['vectors'].item()
-    return None
+def get_papers_by_ids(paper_ids):
+    # one query for all the papers, keep the order of paper_ids
+    papers = ResearchPaper.query.filter(ResearchPaper.id.in_([int(pid) for pid in paper_ids])).all()
+    paper_id_dict = {paper.id: paper for paper in papers}
+    return [paper_id_dict[pid] for pid in paper_ids if pid in paper_id_dict]
 
-@cache.memoize(timeout=CACHE_TIMEOUT)
-def search_papers(query, vectorizer, publication_name=None):
-    settings = read_settings()
+def search_papers(index, query, settings, filters=None, top_n=None):
+    """ Return the `top_n` best (paper_id, score) pairs and the number of matching papers. """
     search_feature = settings['search_feature']
     weights = settings.get('feature_weights', {'tfidf': 1, 'semantic': 1, 'match': 1})
-    # if publication_name:
-    #     papers = ResearchPaper.query.filter(ResearchPaper.publication_name == publication_name).all()
-    # else:
-    #     papers = ResearchPaper.query.all()
-    papers = ResearchPaper.query.all()
-    paper_id_dict = {paper.id: paper for paper in papers}
+    fusion_method = settings.get('fusion_method', 'weighted')
+    features = SEARCH_FEATURES if search_feature == 'combination' else [search_feature]
+    # Filters select the candidate papers before any scoring, None means all papers
+    rows = index.candidate_rows(filters or {})
+    if rows is not None and len(rows) == 0:
+        return [], 0
+
+    # Every feature gives a dense score vector over the candidate rows
+    feature_scores = {}
+    if 'tf-idf' in features:
+        tfidf_query_vector = index.vectorizer.transform([query])
+        feature_scores['tf-idf'] = similarity_feature_scores(index.tfidf_similarities(tfidf_query_vector, rows))
+
+    if 'semantic' in features:
+        # cached per query, so the next pages of a search do not encode it again
+        query_vector = query_encoder.encode(query)
+        feature_scores['semantic'] = similarity_feature_scores(index.semantic_similarities(query_vector, rows))
+
+    if 'match' in features:
+        # the inverted index only visits papers containing a query word
+        feature_scores['match'] = match_feature_scores(index.match_scores(query, rows))
 
-    # Initialize score dictionaries
-    tfidf_scores, semantic_scores, match_scores = {}, {}, {}
-    combined_scores = {}
-
-    # Load TF-IDF feature vectors
-    if search_feature in ['tf-idf', 'combination']:
-        tfidf_feature_matrix = load_tfidf_feature_vectors()
-
-        tfidf_query_vector = vectorizer.transform([query])
-        tfidf_similarities = cosine_similarity(tfidf_feature_matrix, tfidf_query_vector).flatten()
-        for i, score in enumerate(tfidf_similarities):
-            if score > 0:
-                tfidf_scores[papers[i].id] = score
-        # get max score and norm score
-        max_score = max(tfidf_scores.values())
-        for pid in tfidf_scores:
-            tfidf_scores[pid] /= max_score
-            combined_scores[pid] = combined_scores.get(papers[i].id, 0) + tfidf_scores[pid] * weights['tfidf']
-
-    # Load Semantic vectors
-    if search_feature in ['semantic', 'combination']:
-        semantic_vectors = load_semantic_vectors()
-        model = get_sentence_transformer_model()
-        query_vector = model.encode([query])
-        paper_ids = list(semantic_vectors.keys())
-        vectors_matrix = np.array([semantic_vectors[pid] for pid in paper_ids])
-        semantic_similarities = cosine_similarity(query_vector, vectors_matrix)[0]
-        for pid, score in zip(paper_ids, semantic_similarities):
-            if score > 0:
-                semantic_scores[int(pid)] = score
-        # get max score and norm score
-        max_score = max(semantic_scores.values())
-        for pid in semantic_scores:
-            semantic_scores[pid] /= max_score
-            combined_scores[pid] = combined_scores.get(pid, 0) + semantic_scores[pid] * weights['semantic']
-
-    # Match Feature Calculation
-    if search_feature in ['match', 'combination']:
-        query_words = query.lower().split()
-        for paper in papers:
-            score = 0
-            title_words = paper.title.lower().split()
-            authors_words = paper.authors.lower().split()
-            abstract_words = paper.abstract.lower().split()
-
-            for word in query_words:
-                score += 20 if word in title_words else 0
-                score += 10 if word in authors_words else 0
-                score += abstract_words.count(word)
-
-            match_scores[paper.id] = score
-        # get max score and avg score to norm score
-        max_score = max(match_scores.values())
-        avg_score = sum(match_scores.values()) / len(match_scores)
-        for pid in match_scores:
-            match_scores[pid] = (match_scores[pid] - avg_score) / max_score
-            combined_scores[pid] = combined_scores.get(pid, 0) + match_scores[pid] * weights['match']
-
-    # Normalize Scores if in 'combination' mode
     if search_feature == 'combination':
-        max_score = max(combined_scores.values())
-        for pid in combined_scores:
-            combined_scores[pid] /= max_score
-
-    # Choose final scores based on selected feature
-    final_scores = combined_scores if search_feature == 'combination' else match_scores if search_feature == 'match' else semantic_scores if search_feature == 'semantic' else tfidf_scores
+        if fusion_method == 'rrf':
+            final_scores, present = reciprocal_rank_fusion(feature_scores, weights, k=settings.get('rrf_k', 60))
+        else:
+            final_scores, present = weighted_fusion(feature_scores, weights)
+    else:
+        final_scores, present, _ = feature_scores[search_feature]
+    candidates = np.flatnonzero(present)
 
-    # Sort and return papers based on the final scores
-    sorted_papers = sorted([(paper_id_dict[pid], score) for pid, score in final_scores.items()], key=lambda x: x[1], reverse=True)
+    # Only the best top_n papers are ranked, papers are only loaded for the shown page
+    top = candidates[top_k(final_scores[candidates], len(candidates) if top_n is None else top_n)]
+    top_rows = top if rows is None else rows[top]
+    return list(zip(index.paper_ids[top_rows].tolist(), final_scores[top].tolist())), len(candidates)
 
-    if publication_name:
-        sorted_papers = [paper for paper in sorted_papers if paper[0].publication_name == publication_name]
 
-    return sorted_papers
+def cached_search_papers(index, query, filters=None, top_n=None):
+    """ search_papers with the results cached by query, filters, settings and feature version. """
+    settings = read_settings()
+    filters = filters or {}
+    key = search_cache_key(query, filters, settings, index.cache_version)
+    cached = result_cache.get(key, index.cache_version)
+    # a hit must hold the requested results, unless there are no more results
+    if cached is None or (top_n is not None and len(cached[0]) < min(top_n, cached[2])) or (top_n is None and len(cached[0]) < cached[2]):
+        depth = None if top_n is None else max(top_n, MIN_CACHED_RESULTS)
+        ranked, total = search_papers(index, query, settings, filters, top_n=depth)
+        cached = result_cache.set(key, [pid for pid, _ in ranked], [score for _, score in ranked], total, index.cache_version)
+    paper_ids, scores, total = cached
+    if top_n is not None:
+        paper_ids, scores = paper_ids[:top_n], scores[:top_n]
+    return list(zip(paper_ids.tolist(), scores.tolist())), total
+
+
+# Browsing lists the papers newest first, papers without an upload date last. The
+# index on arxiv_upload_date also holds the id (the rowid), so a page after a
+# (date, id) cursor is a single index seek however deep it is.
+BROWSE_ORDER = [ResearchPaper.arxiv_upload_date.desc(), ResearchPaper.id.desc()]
+# only the columns index.html renders, rows are not loaded as ORM objects
+BROWSE_COLUMNS = [ResearchPaper.id, ResearchPaper.title, ResearchPaper.authors, ResearchPaper.abstract,
+                  ResearchPaper.arxiv_id, ResearchPaper.arxiv_upload_date, ResearchPaper.arxiv_category,
+                  ResearchPaper.arxiv_url, ResearchPaper.publication_name, ResearchPaper.publication_date,
+                  ResearchPaper.publication_url]
+
+def encode_cursor(row):
+    return f"{row.arxiv_upload_date.isoformat() if row.arxiv_upload_date else ''}_{row.id}"
+
+def decode_cursor(cursor):
+    """ (arxiv_upload_date, id) of a cursor from encode_cursor, None if it is not valid. """
+    try:
+        date, _, paper_id = cursor.rpartition('_')
+        return (datetime.fromisoformat(date) if date else None), int(paper_id)
+    except (AttributeError, ValueError):
+        return None
 
+def browse_papers(per_page, after=None, before=None, page=1):
+    """ Return (rows, has_more) of a browse page.
+
+    The page follows the `after` cursor, or precedes the `before` cursor, in
+    BROWSE_ORDER. Without cursors, page `page` is read with OFFSET, which is
+    only used when jumping to a page.
+    """
+    select = db.select(*BROWSE_COLUMNS)
+    dated = ResearchPaper.arxiv_upload_date.isnot(None)
+    undated = ResearchPaper.arxiv_upload_date.is_(None)
+    key = tuple_(ResearchPaper.arxiv_upload_date, ResearchPaper.id)
+    if after is None and before is None:
+        rows = db.session.execute(select.order_by(*BROWSE_ORDER).offset((page - 1) * per_page).limit(per_page + 1)).all()
+        return rows[:per_page], len(rows) > per_page
+
+    if before is not None:
+        # walk back from the cursor in ascending order, undated papers first
+        date, paper_id = before
+        if date is None:
+            segments = [select.where(undated, ResearchPaper.id > paper_id).order_by(ResearchPaper.id),
+                        select.where(dated).order_by(ResearchPaper.arxiv_upload_date, ResearchPaper.id)]
+        else:
+            segments = [select.where(dated, key > tuple_(date, paper_id)).order_by(ResearchPaper.arxiv_upload_date, ResearchPaper.id)]
+        limit = per_page
+    else:
+        date, paper_id = after
+        if date is None:
+            segments = [select.where(undated, ResearchPaper.id < paper_id).order_by(ResearchPaper.id.desc())]
+        else:
+            segments = [select.where(dated, key < tuple_(date, paper_id)).order_by(*BROWSE_ORDER),
+                        select.where(undated).order_by(ResearchPaper.id.desc())]
+        limit = per_page + 1
+    rows = []
+    for segment in segments:
+        if len(rows) < limit:
+            rows.extend(db.session.execute(segment.limit(limit - len(rows))).all())
+    if before is not None:
+        return rows[::-1], True
+    return rows[:per_page], len(rows) > per_page
+
+# touched by the scripts that delete papers (database_corrector.py), the count
+# of papers is cached under its modification time and the largest paper id
+PAPERS_DELETED_FILE = 'papers_deleted.stamp'
+
+def mark_papers_deleted(filename=PAPERS_DELETED_FILE):
+    """ Let the servers know that papers were deleted or merged, so they count the papers again. """
+    with open(filename, 'w') as file:
+        file.write(f"{time.time()}\n")
+
+def count_papers():
+    """ Number of papers, cached until a paper is added or deleted, or the cache times out. """
+    max_id = db.session.query(func.max(ResearchPaper.id)).scalar()
+    try:
+        deleted = os.stat(PAPERS_DELETED_FILE).st_mtime_ns
+    except OSError:
+        deleted = 0
+    # max(id) is a single index lookup, counting scans the whole table
+    key = f"paper_count:{max_id}:{deleted}"
+    count = cache.get(key)
+    if count is None:
+        count = db.session.query(func.count(ResearchPaper.id)).scalar()
+        cache.set(key, count, timeout=CACHE_TIMEOUT)
+    return count
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     page = request.args.get('page', 1, type=int)
     per_page = 5
     query = request.args.get('query', None)
-    publication_name = request.args.get('publication_name', None)
+    # publication name, year, arXiv category and author filters
+    filters = {name: request.args.get(name).strip() for name in FILTER_FIELDS if request.args.get(name, '').strip()}
     papers_to_show = []
     total_pages = 0
+    next_cursor, previous_cursor = None, None
     print(f"query={query}")
 
     if query:
-        vectorizer = load_vectorizer()
-        if vectorizer:
-            sorted_papers = search_papers(query, vectorizer, publication_name)
-            papers_to_show = sorted_papers[(page - 1) * per_page: page * per_page]
-            total_pages = int(np.ceil(len(sorted_papers) / per_page))
+        search_index = load_search_index()
+        if search_index:
+            sorted_papers, total_results = cached_search_papers(search_index, query, filters, top_n=page * per_page)
+            page_scores = dict(sorted_papers[(page - 1) * per_page: page * per_page])
+            papers_to_show = [(paper, page_scores[paper.id]) for paper in get_papers_by_ids(list(page_scores))]
+            total_pages = int(np.ceil(total_results / per_page))
     else:
-        papers_query = ResearchPaper.query.order_by(ResearchPaper.arxiv_upload_date.desc())
-        papers_to_show = [(paper, None) for paper in papers_query.paginate(page=page, per_page=per_page, error_out=False).items]
-        total_pages = papers_query.paginate(page=page, per_page=per_page, error_out=False).pages
-    return render_template('index.html', papers=papers_to_show, total_pages=total_pages, current_page=page, query=query, publication_name=publication_name)
-
-
-def find_similar_papers(paper_id, top_n=25):
-    # feature_matrix = load_tfidf_feature_vectors()
-    # papers = ResearchPaper.query.all()
-
-    # if feature_matrix is None or len(papers) == 0:
-    #     return []
-    # try:
-    #     target_index = [p.id for p in papers].index(paper_id)
-    #     target_vector = feature_matrix[target_index]
-    # except ValueError:
-    #     # paper_id not found in the list of IDs
-    #     print(f"Paper ID {paper_id} not found in the database.")
-    #     return []
-
-    # similarities = cosine_similarity(feature_matrix, target_vector).flatten()
-
-    # # Sort and get top N indices, excluding the target paper itself
-    # similar_indices = np.argsort(similarities)[::-1]
-    # similar_indices = [idx for idx in similar_indices if papers[idx].id != paper_id][:top_n]
-
-    # similar_papers = [(papers[idx], similarities[idx]) for idx in similar_indices]
-    # print(similar_indices)
-    # return similar_papers
+        rows, has_more = browse_papers(per_page, after=decode_cursor(request.args.get('after')),
+                                       before=decode_cursor(request.args.get('before')), page=max(page, 1))
+        papers_to_show = [(row, None) for row in rows]
+        total_pages = int(np.ceil(count_papers() / per_page))
+        if rows:
+            next_cursor = encode_cursor(rows[-1]) if has_more else None
+            previous_cursor = encode_cursor(rows[0]) if page > 1 else None
+    return render_template('index.html', papers=papers_to_show, total_pages=total_pages, current_page=page, query=query, filters=filters,
+                           next_cursor=next_cursor, previous_cursor=previous_cursor)
+
+
+def similar_paper_scores(search_index, paper_id, top_n=25, backend='exact', use_precomputed=False):
+    """ The `top_n` most similar (paper_id, score) pairs, None if the paper has no semantic vector. """
     start_time = time.time()
-    semantic_vectors = load_semantic_vectors()
-    if not semantic_vectors or str(paper_id) not in semantic_vectors:
-        flash(f"Semantic vector for paper ID {paper_id} not found.", "error")
-        return []
-
-    # Convert semantic vectors to a matrix
-    paper_ids = list(semantic_vectors.keys())
-    vectors_matrix = np.array([semantic_vectors[pid] for pid in paper_ids])
+    target_row = search_index.semantic_row(paper_id)
+    if target_row is None:
+        return None
 
-    target_vector = semantic_vectors[str(paper_id)]
+    target_vector = search_index.semantic_matrix[target_row]
     print(f"Time for loading semantic vectors: {time.time() - start_time} seconds.")
     start_time = time.time()
-    # Compute similarities in bulk
-    similarities = cosine_similarity([target_vector], vectors_matrix)[0]
-    print(f"Time for computing similarities: {time.time() - start_time} seconds.")
-    start_time = time.time()
-
-    # Create a list of (paper_id, similarity) tuples, excluding the target paper
-    paper_scores = [(int(pid), sim) for pid, sim in zip(paper_ids, similarities) if pid != str(paper_id)]
-    print(f"Time for creating tuples: {time.time() - start_time} seconds.")
-    start_time = time.time()
-    # Sort by similarity and select top N
-    similar_papers = sorted(paper_scores, key=lambda x: x[1], reverse=True)[:top_n]
-    similar_papers = [(ResearchPaper.query.get(pid), sim) for pid, sim in similar_papers]
-    print(f"Time for sorting and selecting top N: {time.time() - start_time} seconds.")
+    similar_scores = None
+    precomputed = search_index.precomputed_similar(paper_id, top_n) if use_precomputed else None
+    if precomputed is not None:
+        # one lookup in the table computed by compute_feature.py
+        similar_scores = list(zip(precomputed[0].tolist(), precomputed[1].tolist()))
+        print(f"Time for looking up precomputed similar papers: {time.time() - start_time} seconds.")
+    elif backend == 'hnsw' and search_index.semantic_ann is not None:
+        try:
+            # approximate neighbours, a few extra in case the target or deleted papers are returned
+            candidate_ids, candidate_scores = search_index.semantic_ann.query(target_vector, top_n + 10)
+            keep = (candidate_ids != paper_id) & (search_index.rows_of(candidate_ids) >= 0)
+            similar_scores = list(zip(candidate_ids[keep][:top_n].tolist(), candidate_scores[keep][:top_n].tolist()))
+            print(f"Time for querying the ANN index: {time.time() - start_time} seconds.")
+        except RuntimeError as e:
+            print(f"ANN query failed, falling back to exact search: {e}")
+    if similar_scores is None:
+        # Compute similarities in bulk, rows are normalised so this is cosine similarity
+        similarities = search_index.semantic_matrix @ target_vector
+        print(f"Time for computing similarities: {time.time() - start_time} seconds.")
+        start_time = time.time()
+
+        # Exclude the target paper and papers deleted since the features were computed
+        similarities[target_row] = -np.inf
+        similarities[search_index.semantic_rows < 0] = -np.inf
+        top = top_k(similarities, top_n)
+        top = top[np.isfinite(similarities[top])]
+        similar_scores = list(zip(search_index.semantic_ids[top].tolist(), similarities[top].tolist()))
+        print(f"Time for selecting top N: {time.time() - start_time} seconds.")
+    return similar_scores
+
+
+def cached_similar_papers(search_index, paper_id, top_n=None):
+    """ similar_paper_scores and the number of similar papers, cached like cached_search_papers.
+
+    None if the paper has no semantic vector. With `top_n` None all the papers are ranked.
+    """
+    settings = read_settings()
+    use_precomputed = settings.get('precompute_similar', False)
+    table_size = search_index.similar_table[1].shape[1] if use_precomputed and search_index.similar_table is not None else 0
+    key = similar_cache_key(paper_id, settings, search_index.cache_version)
+    cached = result_cache.get(key, search_index.cache_version)
+    if cached is None or (top_n is not None and len(cached[0]) < min(top_n, cached[2])) or (top_n is None and len(cached[0]) < cached[2]):
+        if search_index.semantic_row(paper_id) is None:
+            return None
+        # every other paper still in the database is similar to some degree
+        candidates = max(int((search_index.semantic_rows >= 0).sum()) - 1, 0)
+        # the precomputed table holds the first results, deeper pages than the cached
+        # ranking double it, so paging through n results ranks log(n) times
+        if top_n is None:
+            depth = candidates
+        elif top_n <= table_size:
+            depth = top_n
+        else:
+            depth = max(top_n, MIN_CACHED_RESULTS, 2 * len(cached[0]) if cached is not None else 0)
+        ranked = similar_paper_scores(search_index, paper_id, top_n=depth,
+                                      backend=settings.get('similar_search_backend', 'exact'),
+                                      use_precomputed=use_precomputed)
+        # a short ranking (e.g. from the ANN index) holds all the papers it can find
+        total = candidates if len(ranked) >= depth else len(ranked)
+        cached = result_cache.set(key, [pid for pid, _ in ranked], [score for _, score in ranked], total, search_index.cache_version)
+    paper_ids, scores, total = cached
+    if top_n is not None:
+        paper_ids, scores = paper_ids[:top_n], scores[:top_n]
+    return list(zip(paper_ids.tolist(), scores.tolist())), total
+
+
+def find_similar_papers(paper_id, top_n=25, backend='exact', use_precomputed=False):
+    search_index = get_search_index(load_index_papers)
+    similar_scores = similar_paper_scores(search_index, paper_id, top_n, backend, use_precomputed)
+    if similar_scores is None:
+        flash(f"Semantic vector for paper ID {paper_id} not found.", "error")
+        return []
+    similar_scores = dict(similar_scores)
+    similar_papers = [(paper, similar_scores[paper.id]) for paper in get_papers_by_ids(list(similar_scores))]
 
     return similar_papers
 
@@ -254,9 +489,163 @@ def similar_papers(paper_id):
     base_paper = ResearchPaper.query.get_or_404(paper_id)
     settings = read_settings()
     number_of_similar_papers = settings['number_of_similar_papers']
-    similar = find_similar_papers(paper_id, top_n=number_of_similar_papers)
+    similar = find_similar_papers(paper_id, top_n=number_of_similar_papers,
+                                  backend=settings.get('similar_search_backend', 'exact'),
+                                  use_precomputed=settings.get('precompute_similar', False))
     return render_template('similar_papers.html', base_paper=base_paper, similar_papers=similar)
 
+# JSON API, results are ranked {id, score} lists with the paper fields asked for
+API_DEFAULT_LIMIT = 25
+API_MAX_LIMIT = 1000
+# fields of ResearchPaper.to_dict that can be requested
+API_FIELDS = ['title', 'authors', 'abstract', 'arxiv_id', 'arxiv_upload_date', 'arxiv_category', 'arxiv_url',
+              'publication_name', 'publication_date', 'publication_url']
+# NDJSON streams load the requested fields of this many papers at a time
+API_STREAM_CHUNK_SIZE = 500
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(APIError)
+def handle_api_error(error):
+    return jsonify({'error': str(error)}), error.status
+
+def api_fields(value):
+    """ Requested fields, from a comma separated string or a list. """
+    fields = split_names(value) if isinstance(value, str) else list(value or [])
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        raise APIError(f"Unknown fields {', '.join(unknown)}, available fields are {', '.join(API_FIELDS)}")
+    return fields
+
+def api_limit(value):
+    try:
+        limit = int(value) if value is not None else API_DEFAULT_LIMIT
+    except (TypeError, ValueError):
+        raise APIError("limit must be an integer")
+    if not 1 <= limit <= API_MAX_LIMIT:
+        raise APIError(f"limit must be between 1 and {API_MAX_LIMIT}")
+    return limit
+
+# Cursors are the offset in a ranked result, tied to the features it was ranked with
+def encode_api_cursor(search_index, offset):
+    return f"{search_index.cache_version}:{offset}"
+
+def decode_api_cursor(search_index, cursor):
+    if not cursor:
+        return 0
+    version, _, offset = cursor.rpartition(':')
+    if version != str(search_index.cache_version) or not offset.isdigit():
+        raise APIError("The cursor is not valid or the features changed since, start again without a cursor", 410)
+    return int(offset)
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+
+def api_results(ranked, fields):
+    """ [{id, score, fields...}] of ranked (paper_id, score) pairs, papers deleted since are skipped. """
+    if not fields:
+        return [{'id': paper_id, 'score': score} for paper_id, score in ranked]
+    scores = dict(ranked)
+    results = []
+    for paper in get_papers_by_ids(list(scores)):
+        paper_dict = paper.to_dict()
+        result = {'id': paper.id, 'score': scores[paper.id]}
+        result.update({field: paper_dict[field] for field in fields})
+        results.append(result)
+    return results
+
+def stream_api_results(ranked, fields):
+    """ NDJSON response with one line per result, papers are loaded a chunk at a time. """
+    def generate():
+        for start in range(0, len(ranked), API_STREAM_CHUNK_SIZE):
+            for result in api_results(ranked[start:start + API_STREAM_CHUNK_SIZE], fields):
+                yield json.dumps(result) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def api_search_index():
+    search_index = get_search_index(load_index_papers)
+    if search_index.vectorizer is None or search_index.tfidf_matrix is None or search_index.semantic_matrix is None or search_index.match_index is None:
+        raise APIError("Feature files not found, run 'compute_feature.py' first", 503)
+    return search_index
+
+def api_search_page(search_index, spec, limit, cursor, fields):
+    """ One page of the search described by `spec`, a dict with the query and the filters. """
+    query = str(spec.get('query') or '').strip()
+    if not query:
+        raise APIError("query is required")
+    filters = {name: str(spec[name]).strip() for name in FILTER_FIELDS if str(spec.get(name) or '').strip()}
+    offset = decode_api_cursor(search_index, cursor)
+    ranked, total = cached_search_papers(search_index, query, filters, top_n=offset + limit)
+    next_offset = offset + limit
+    return {
+        'query': query,
+        'filters': filters,
+        'total': total,
+        'results': api_results(ranked[offset:next_offset], fields),
+        'next_cursor': encode_api_cursor(search_index, next_offset) if next_offset < total else None,
+    }
+
+@app.route('/api/search', methods=['GET', 'POST'])
+def api_search():
+    """ Ranked search results.
+
+    GET takes the query, the filters, `limit`, `cursor` and `fields` as
+    arguments. With `format=ndjson` all the results after the cursor are
+    streamed, one per line. POST takes {"queries": [{"query": ..., filters...}],
+    "limit": ..., "fields": [...]} and answers all the queries at once, with
+    the semantic query vectors encoded in one batch.
+    """
+    search_index = api_search_index()
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        specs = body.get('queries')
+        if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+            raise APIError("queries must be a non-empty list of objects")
+        limit, fields = api_limit(body.get('limit')), api_fields(body.get('fields'))
+        if read_settings()['search_feature'] in ['semantic', 'combination']:
+            query_encoder.encode_many([str(spec.get('query') or '').strip() for spec in specs])
+        return jsonify({'results': [api_search_page(search_index, spec, limit, spec.get('cursor'), fields) for spec in specs]})
+
+    fields = api_fields(request.args.get('fields', ''))
+    if wants_ndjson():
+        query = request.args.get('query', '').strip()
+        if not query:
+            raise APIError("query is required")
+        filters = {name: request.args.get(name).strip() for name in FILTER_FIELDS if request.args.get(name, '').strip()}
+        offset = decode_api_cursor(search_index, request.args.get('cursor'))
+        ranked, _ = cached_search_papers(search_index, query, filters)
+        return stream_api_results(ranked[offset:], fields)
+    return jsonify(api_search_page(search_index, request.args, api_limit(request.args.get('limit')),
+                                   request.args.get('cursor'), fields))
+
+@app.route('/api/similar/<int:paper_id>', methods=['GET'])
+def api_similar(paper_id):
+    """ Ranked similar papers, with the same `limit`, `cursor`, `fields` and `format` arguments as /api/search. """
+    if db.session.get(ResearchPaper, paper_id) is None:
+        raise APIError(f"Paper {paper_id} not found", 404)
+    search_index = api_search_index()
+    fields = api_fields(request.args.get('fields', ''))
+    offset = decode_api_cursor(search_index, request.args.get('cursor'))
+    streaming = wants_ndjson()
+    # streams rank all the papers, pages only as deep as needed
+    limit = None if streaming else api_limit(request.args.get('limit'))
+    similar = cached_similar_papers(search_index, paper_id, top_n=None if streaming else offset + limit)
+    if similar is None:
+        raise APIError(f"Semantic vector for paper ID {paper_id} not found", 404)
+    ranked, total = similar
+    if streaming:
+        return stream_api_results(ranked[offset:], fields)
+    next_offset = offset + limit
+    return jsonify({
+        'id': paper_id,
+        'total': total,
+        'results': api_results(ranked[offset:next_offset], fields),
+        'next_cursor': encode_api_cursor(search_index, next_offset) if next_offset < total else None,
+    })
+
 @app.route('/edit_paper/<int:paper_id>', methods=['GET'])
 def edit_paper(paper_id):
     paper = ResearchPaper.query.get_or_404(paper_id)
@@ -265,14 +654,18 @@ def edit_paper(paper_id):
 
 @app.route('/update_paper', methods=['POST'])
 def update_paper():
+    from compute_feature import compute_hash
     paper_id = request.form['id']
     paper = ResearchPaper.query.get_or_404(paper_id)
+    old_hash = compute_hash(paper)
+    old_index_row = index_row_of(paper)
 
     # Update fields
     paper.title = request.form['title']
     paper.authors = request.form['authors']
     paper.abstract = request.form['abstract']
-    paper.arxiv_id = request.form.get('arxiv_id')
+    # arxiv_id is unique, papers without one store NULL rather than ''
+    paper.arxiv_id = request.form.get('arxiv_id') or None
 
     # Handle dates
     arxiv_upload_date = request.form.get('arxiv_upload_date')
@@ -296,9 +689,45 @@ def update_paper():
 
 
     db.session.commit()
+    paper_hash = compute_hash(paper)
+    if paper_hash != old_hash or index_row_of(paper) != old_index_row:
+        # searches see the edit right away, the feature files follow with the job
+        refresh_paper_features(paper, paper_hash if paper_hash != old_hash else None, old_index_row)
+    job_runner.submit('compute_features')
     flash('Paper updated successfully!')
     return redirect(url_for('similar_papers', paper_id=paper_id))
 
+def index_row_of(paper):
+    # the filter columns of a paper, as load_index_papers reads them
+    return (paper.id, paper.publication_name, paper.publication_date, paper.arxiv_upload_date,
+            paper.arxiv_category, paper.authors)
+
+def refresh_paper_features(paper, paper_hash, old_index_row):
+    """ Patch an edited paper into the search index of every server process, and its vector into the semantic store.
+
+    The edit is appended to the patch log, which each process applies to its
+    index (see SearchIndex.apply_patches). The filters are always updated.
+    When the text changed (`paper_hash` is not None) the paper is re-vectorised
+    and re-indexed for match search; its vector is also saved as a semantic
+    checkpoint with the new hash, so compute_feature.py does not encode the
+    paper again.
+    """
+    import compute_feature
+    start_time = time.time()
+    search_index = get_search_index(load_index_papers)
+    if paper_hash is None:
+        append_patch(search_index.version, paper.id, old_index_row, index_row_of(paper))
+        search_index.apply_patches()
+        return
+    semantic_vector = normalize_rows(query_encoder.get_model().encode([compute_feature.conbine_text_semantic(paper)])[0])
+    append_patch(search_index.version, paper.id, old_index_row, index_row_of(paper),
+                 tfidf_text=compute_feature.combine_text_tfidf(paper), semantic_vector=semantic_vector,
+                 match_texts=(paper.title, paper.authors, paper.abstract))
+    search_index.apply_patches()
+    if patch_semantic_store(paper.id, semantic_vector):
+        compute_feature.save_semantic_checkpoint([paper.id], [paper_hash], [semantic_vector])
+    print(f"Features of paper {paper.id} refreshed in {time.time() - start_time} seconds.")
+
 @app.route('/settings', methods=['GET'])
 def settings():
     with open('settings.json', 'r') as file:
@@ -307,7 +736,9 @@ def settings():
 
 @app.route('/update_settings', methods=['POST'])
 def update_settings():
-    settings = {
+    # keep settings that are not on the form
+    settings = read_settings()
+    settings.update({
         "default_arxiv_query": request.form['default_arxiv_query'],
         "number_of_similar_papers": int(request.form['number_of_similar_papers']),
         "search_feature": request.form['search_feature'],
@@ -315,13 +746,60 @@ def update_settings():
             "tfidf": int(request.form['tfidf_weight']),
             "semantic": int(request.form['semantic_weight']),
             "match": int(request.form['match_weight'])
-        }
-    }
+        },
+        "fusion_method": request.form.get('fusion_method', 'weighted'),
+        "similar_search_backend": request.form.get('similar_search_backend', 'exact'),
+        "precompute_similar": 'precompute_similar' in request.form
+    })
     with open('settings.json', 'w') as file:
         json.dump(settings, file)
     flash('Settings updated successfully!')
     return redirect(url_for('settings'))
 
+@app.before_request
+def start_loading_query_encoder():
+    # every process serving requests (dev server, gunicorn worker) starts loading the model
+    # with its first request, which is usually the first readiness probe
+    query_encoder.start_loading()
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # readiness probe, the semantic model is loaded in the background from the first request
+    status = {'query_encoder': query_encoder.ready, 'query_encoder_backend': query_encoder.backend}
+    return jsonify(status), 200 if query_encoder.ready else 503
+
+# Background jobs, the scripts are imported when a job runs since they import this module
+def run_compute_features_job(progress):
+    import compute_feature
+    # reuse the model of the server, other backends give slightly different vectors
+    model = query_encoder.get_model() if query_encoder.backend == 'torch' else None
+    return compute_feature.compute_features(model=model, progress=progress)
+
+def run_fetch_arxiv_job(progress):
+    import arxiv_fetcher
+    progress('fetch')
+    total, new, updated, exists = arxiv_fetcher.harvest_arxiv_papers(read_settings()['default_arxiv_query'])
+    if new or updated:
+        job_runner.submit('compute_features')
+    return {'fetched': total, 'new': new, 'updated': updated, 'existing': exists}
+
+job_runner.register('compute_features', run_compute_features_job)
+job_runner.register('fetch_arxiv', run_fetch_arxiv_job)
+
+@app.route('/jobs', methods=['GET'])
+def jobs_status():
+    return jsonify(job_runner.status())
+
+@app.route('/jobs/<name>', methods=['POST'])
+def submit_job(name):
+    if name not in job_runner.jobs:
+        return jsonify({'error': f"Unknown job {name}"}), 404
+    job = job_runner.submit(name)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.to_dict()), 202
+    flash(f"Job {name} queued.")
+    return redirect(url_for('settings'))
+
 def create_default_settings():
     default_settings = {
         "default_arxiv_query": "cat:cs.CV+OR+cat:cs.LG+OR+cat:cs.CL+OR+cat:cs.AI+OR+cat:cs.CR+OR+cat:eess.AS&sortBy=lastUpdatedDate&sortOrder=descending",
@@ -331,7 +809,11 @@ def create_default_settings():
             "tfidf": 1,
             "semantic": 1,
             "match": 1
-        }
+        },
+        "fusion_method": "weighted",
+        "rrf_k": 60,
+        "similar_search_backend": "exact",
+        "precompute_similar": False
     }
     with open('settings.json', 'w') as file:
         json.dump(default_settings, file)
@@ -345,7 +827,15 @@ def setup_database(app):
     with app.app_context():
         db.create_all()
 
+def warm_search_index(app):
+    # load the search index at startup instead of in the first request
+    with app.app_context():
+        get_search_index(load_index_papers)
+
 if __name__ == '__main__':
     check_settings_file()
     setup_database(app)
+    # the debug reloader runs this twice, only its child process serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_search_index(app)
     app.run(debug=True, port=40500)
\ No newline at end of file
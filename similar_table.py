@@ -0,0 +1,115 @@
+import os
+import time
+import numpy as np
+from semantic_store import save_array, find_rows, DEFAULT_MMAP_MODE
+
+# Top-N most similar papers of every paper. Row i of the neighbour and score
+# tables belongs to paper_ids[i]; rows are padded with -1 ids when there are
+# fewer than N other papers.
+SIMILAR_IDS_FILE = 'similar_paper_ids.npy'
+SIMILAR_NEIGHBOURS_FILE = 'similar_neighbours.npy'
+SIMILAR_SCORES_FILE = 'similar_scores.npy'
+
+
+def neighbour_dtype(paper_ids):
+    # paper ids are small in practice, int32 halves the table
+    return np.int32 if len(paper_ids) == 0 or paper_ids.max() < np.iinfo(np.int32).max else np.int64
+
+
+def select_top(candidate_ids, candidate_scores, top_n):
+    """ Best `top_n` candidates of every row, highest score first. """
+    n_rows, n_candidates = candidate_scores.shape
+    k = min(top_n, n_candidates)
+    neighbours = np.full((n_rows, top_n), -1, dtype=np.int64)
+    scores = np.full((n_rows, top_n), -np.inf, dtype=np.float32)
+    if k == 0:
+        return neighbours, scores
+    selected = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+    selected_scores = np.take_along_axis(candidate_scores, selected, axis=1)
+    order = np.argsort(-selected_scores, axis=1, kind='stable')
+    selected = np.take_along_axis(selected, order, axis=1)
+    scores[:, :k] = np.take_along_axis(selected_scores, order, axis=1)
+    neighbours[:, :k] = np.take_along_axis(candidate_ids, selected, axis=1) if candidate_ids.ndim == 2 else candidate_ids[selected]
+    neighbours[~np.isfinite(scores)] = -1
+    return neighbours, scores
+
+
+def compute_neighbours(paper_ids, matrix, rows, top_n, block_size=1024):
+    """ Exact top-N neighbours of `rows`, one block of rows against all papers at a time. """
+    neighbours = np.full((len(rows), top_n), -1, dtype=np.int64)
+    scores = np.full((len(rows), top_n), -np.inf, dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        similarities = np.asarray(matrix[block_rows] @ matrix.T, dtype=np.float32)
+        # a paper is not its own neighbour
+        similarities[np.arange(len(block_rows)), block_rows] = -np.inf
+        neighbours[start:start + block_size], scores[start:start + block_size] = select_top(paper_ids, similarities, top_n)
+    return neighbours, scores
+
+
+def load_similar_table(mmap_mode=DEFAULT_MMAP_MODE, directory=''):
+    """ Return (paper_ids, neighbours, scores), or None if no table is stored. """
+    ids_file, neighbours_file, scores_file = [os.path.join(directory, f) for f in [SIMILAR_IDS_FILE, SIMILAR_NEIGHBOURS_FILE, SIMILAR_SCORES_FILE]]
+    if not all(os.path.exists(f) for f in [ids_file, neighbours_file, scores_file]):
+        return None
+    return (np.load(ids_file), np.load(neighbours_file, mmap_mode=mmap_mode), np.load(scores_file, mmap_mode=mmap_mode))
+
+
+def update_similar_table(paper_ids, matrix, changed_ids=None, top_n=25, block_size=1024):
+    """ Bring the similar papers table in line with the semantic store.
+
+    Only rows of new or changed papers (`changed_ids` and the papers missing
+    from the table), and rows that listed a changed or removed paper, are
+    recomputed. The other rows are merged with the similarities to
+    the changed papers.
+    """
+    start_time = time.time()
+    table = load_similar_table(mmap_mode=None)
+    if table is not None and table[1].shape[1] != top_n:
+        print(f"Similar papers table has {table[1].shape[1]} neighbours per paper, recomputing it for {top_n}.")
+        table = None
+    if table is None:
+        recompute_rows = np.arange(len(paper_ids))
+        carried_rows = np.zeros(0, dtype=np.int64)
+        table_rows = np.zeros(0, dtype=np.int64)
+        changed_rows = np.zeros(0, dtype=np.int64)
+    else:
+        table_ids, table_neighbours, table_scores = table
+        table_rows = find_rows(table_ids, paper_ids)
+        # papers missing from the table are new candidates of every row too, also when they were
+        # added while the table was not kept up to date and are not among `changed_ids`
+        missing_ids = paper_ids[table_rows < 0]
+        changed_ids = missing_ids if changed_ids is None else np.union1d(np.asarray(changed_ids, dtype=np.int64), missing_ids)
+        changed_rows = find_rows(paper_ids, changed_ids)
+        changed_rows = changed_rows[changed_rows >= 0]
+        removed_ids = np.setdiff1d(table_ids, paper_ids)
+        stale_ids = np.union1d(removed_ids, paper_ids[changed_rows])
+        # rows that listed a removed or changed paper can not be patched, its score may have dropped
+        stale = np.zeros(len(paper_ids), dtype=bool)
+        stale[changed_rows] = True
+        stale[table_rows < 0] = True
+        known = table_rows >= 0
+        stale[known] |= np.isin(table_neighbours[table_rows[known]], stale_ids).any(axis=1)
+        recompute_rows = np.flatnonzero(stale)
+        carried_rows = np.flatnonzero(~stale)
+
+    neighbours = np.full((len(paper_ids), top_n), -1, dtype=np.int64)
+    scores = np.full((len(paper_ids), top_n), -np.inf, dtype=np.float32)
+    neighbours[recompute_rows], scores[recompute_rows] = compute_neighbours(paper_ids, matrix, recompute_rows, top_n, block_size)
+
+    changed_vectors = matrix[changed_rows]
+    for start in range(0, len(carried_rows), block_size):
+        block_rows = carried_rows[start:start + block_size]
+        old_neighbours = table_neighbours[table_rows[block_rows]].astype(np.int64)
+        old_scores = table_scores[table_rows[block_rows]].astype(np.float32)
+        old_scores[old_neighbours < 0] = -np.inf
+        # the changed papers are the only new candidates of these rows
+        candidate_ids = np.hstack([old_neighbours, np.broadcast_to(paper_ids[changed_rows], (len(block_rows), len(changed_rows)))])
+        candidate_scores = np.hstack([old_scores, np.asarray(matrix[block_rows] @ changed_vectors.T, dtype=np.float32)])
+        neighbours[block_rows], scores[block_rows] = select_top(candidate_ids, candidate_scores, top_n)
+
+    scores[neighbours < 0] = 0
+    save_array(SIMILAR_NEIGHBOURS_FILE, neighbours.astype(neighbour_dtype(paper_ids)))
+    save_array(SIMILAR_SCORES_FILE, scores.astype(np.float16))
+    save_array(SIMILAR_IDS_FILE, np.asarray(paper_ids, dtype=np.int64))
+    print(f"Similar papers table updated, {len(recompute_rows)} rows recomputed and {len(carried_rows)} rows merged, in {time.time() - start_time} seconds.")
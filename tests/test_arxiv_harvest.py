@@ -0,0 +1,138 @@
+""" Harvest mode of arxiv_fetcher.py against a local stub of the arXiv API.
+
+The database is not touched, ingest_papers is replaced by a recorder.
+Run from the project root with `python -m unittest discover tests`.
+"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import arxiv_fetcher
+
+QUERY = 'cat:cs.CR'
+OLD_DATE = datetime(2000, 1, 1)
+
+
+def make_entries(count, newest=datetime(2025, 1, 1)):
+    """ (updated, xml) of `count` papers, newest first, one hour apart. """
+    entries = []
+    for i in range(count):
+        updated = (newest - timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        arxiv_id = f"2501.{newest.day:02d}{i:03d}"
+        entries.append((updated, f"<entry><id>http://arxiv.org/abs/{arxiv_id}v1</id><published>{updated}</published>"
+                                 f"<updated>{updated}</updated><title>Stub paper {i}</title><summary>Abstract {i}</summary>"
+                                 f"<author><name>Stub Author</name></author><category term=\"cs.CR\"/></entry>"))
+    return entries
+
+
+class StubArxiv(BaseHTTPRequestHandler):
+    # set by the tests: the listing, and the `start` values answered with 503
+    entries = []
+    failing_starts = set()
+    requests = []
+
+    def do_GET(self):
+        arguments = parse_qs(urlparse(self.path).query)
+        start, size = int(arguments['start'][0]), int(arguments['max_results'][0])
+        StubArxiv.requests.append(start)
+        if start in StubArxiv.failing_starts:
+            self.send_response(503)
+            self.end_headers()
+            self.wfile.write(b"Service Unavailable")
+            return
+        body = ('<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom" '
+                'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+                f'<opensearch:totalResults>{len(StubArxiv.entries)}</opensearch:totalResults>'
+                + ''.join(xml for _, xml in StubArxiv.entries[start:start + size]) + '</feed>')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/atom+xml')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class HarvestTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubArxiv)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_url = f"http://127.0.0.1:{cls.server.server_port}/api/query?search_query="
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.directory.name, 'state.json')
+        self.ingested = []
+        self.original_ingest = arxiv_fetcher.ingest_papers
+        arxiv_fetcher.ingest_papers = self.record
+        StubArxiv.entries, StubArxiv.failing_starts, StubArxiv.requests = make_entries(250), set(), []
+
+    def tearDown(self):
+        arxiv_fetcher.ingest_papers = self.original_ingest
+        self.directory.cleanup()
+
+    def record(self, papers):
+        self.ingested.extend(paper['arxiv_id'] for paper in papers)
+        return len(papers), 0, 0
+
+    def harvest(self, **kwargs):
+        kwargs.setdefault('since', OLD_DATE)
+        return arxiv_fetcher.harvest_arxiv_papers(QUERY, page_size=100, delay=0, api_url=self.api_url,
+                                                  state_file=self.state_file, **kwargs)
+
+    def state(self):
+        with open(self.state_file) as file:
+            return json.load(file)[QUERY]
+
+    def test_complete_harvest_sets_the_mark(self):
+        self.assertEqual(self.harvest()[0], 250)
+        self.assertEqual(self.state(), {'high_water_mark': StubArxiv.entries[0][0]})
+
+    def test_next_harvest_stops_at_the_mark(self):
+        self.harvest()
+        StubArxiv.entries = make_entries(5, newest=datetime(2025, 1, 2)) + StubArxiv.entries
+        self.ingested = []
+        self.harvest()
+        # the new papers, and the papers updated in the same second as the mark
+        self.assertEqual(len(self.ingested), 6)
+        self.assertEqual(StubArxiv.requests[-1], 0)
+
+    def test_failed_page_is_retried_by_the_next_run(self):
+        StubArxiv.failing_starts = {100}
+        with self.assertRaises(ConnectionError):
+            self.harvest()
+        state = self.state()
+        self.assertEqual(state['next_start'], 100)
+        self.assertIsNone(state['high_water_mark'])
+        StubArxiv.failing_starts = set()
+        self.harvest()
+        self.assertEqual(len(set(self.ingested)), 250)
+        self.assertEqual(self.state(), {'high_water_mark': StubArxiv.entries[0][0]})
+
+    def test_max_results_does_not_move_the_mark(self):
+        self.harvest(max_results=100)
+        state = self.state()
+        self.assertEqual(state['next_start'], 100)
+        self.assertIsNone(state['high_water_mark'])
+        self.harvest()
+        self.assertEqual(len(set(self.ingested)), 250)
+        self.assertNotIn('next_start', self.state())
+
+    def test_first_harvest_stops_at_since(self):
+        self.harvest(since=datetime(2025, 1, 1) - timedelta(hours=49))
+        self.assertEqual(len(self.ingested), 50)
+        self.assertEqual(self.state(), {'high_water_mark': StubArxiv.entries[0][0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+""" Incremental updates of the similar papers table of similar_table.py.
+
+The table files are relative to the working directory, every test runs in a
+temporary one. Run from the project root with `python -m unittest discover tests`.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from semantic_store import normalize_rows
+from similar_table import compute_neighbours, load_similar_table, update_similar_table
+
+TOP_N = 5
+
+
+def random_vectors(count, dim=16, seed=0):
+    return normalize_rows(np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32))
+
+
+class SimilarTableTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_directory = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.original_directory)
+        self.directory.cleanup()
+
+    def assertExact(self, paper_ids, matrix):
+        table_ids, neighbours, _ = load_similar_table(mmap_mode=None)
+        np.testing.assert_array_equal(table_ids, paper_ids)
+        exact, _ = compute_neighbours(paper_ids, matrix, np.arange(len(paper_ids)), TOP_N)
+        np.testing.assert_array_equal(neighbours, exact)
+
+    def test_changed_papers_are_merged(self):
+        paper_ids, matrix = np.arange(1, 51, dtype=np.int64), random_vectors(50)
+        update_similar_table(paper_ids, matrix, top_n=TOP_N)
+        matrix[[3, 20]] = random_vectors(2, seed=1)
+        update_similar_table(paper_ids, matrix, changed_ids=paper_ids[[3, 20]], top_n=TOP_N)
+        self.assertExact(paper_ids, matrix)
+
+    def test_paper_missing_from_the_table_and_the_changed_ids(self):
+        # e.g. added while precompute_similar was off, the caller only knows about paper 5
+        matrix = random_vectors(50)
+        update_similar_table(np.arange(1, 41, dtype=np.int64), matrix[:40], top_n=TOP_N)
+        paper_ids = np.arange(1, 51, dtype=np.int64)
+        matrix[4] = random_vectors(1, seed=2)[0]
+        update_similar_table(paper_ids, matrix, changed_ids=[5], top_n=TOP_N)
+        self.assertExact(paper_ids, matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()